@@ -202,7 +202,7 @@ class DiTBlock(nn.Module):
             approximate='tanh'), nn.Linear(ffn_dim, dim))
         self.modulation = nn.Parameter(torch.randn(1, 6, dim) / dim**0.5)
 
-    def forward(self, x, context, cam_emb, t_mod, freqs):
+    def forward(self, x, context, cam_emb, t_mod, freqs, cam_emb_encoded=False):
         # msa: multi-head self-attention  mlp: multi-layer perceptron
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (
             self.modulation.to(dtype=t_mod.dtype, device=t_mod.device) + t_mod).chunk(6, dim=1)
@@ -210,8 +210,10 @@ class DiTBlock(nn.Module):
 
         if cam_emb is not None:
             # 🔧 修改：处理类别embedding
-            cam_emb = cam_emb.to(self.cam_encoder.weight.dtype)
-            cam_emb = self.cam_encoder(cam_emb)  # [batch, frames, dim]
+            # cam_emb_encoded: cam_emb 已由 WanModel.encode_cameras 批量编码为 [batch, frames, dim]；否则是原始12维位姿，在这里编码
+            if not cam_emb_encoded:
+                cam_emb = cam_emb.to(self.cam_encoder.weight.dtype)
+                cam_emb = self.cam_encoder(cam_emb)  # [batch, frames, dim]
             #if not self.training:
             # cam_emb = torch.cat([torch.zeros_like(cam_emb).repeat(1, 2, 1), cam_emb], dim=1)
 
@@ -327,6 +329,21 @@ class WanModel(torch.nn.Module):
         if has_image_input:
             self.img_emb = MLP(1280, dim)  # clip_feature_dim = 1280
 
+        # 推理用的 cam_encoder 堆叠权重缓存；load_state_dict 与 .to()/.half() 等之后失效
+        self._cam_encoder_stack = None
+        self.register_load_state_dict_post_hook(lambda module, incompatible_keys: module.clear_cam_encoder_stack())
+
+    def _apply(self, fn, *args, **kwargs):
+        self.clear_cam_encoder_stack()
+        return super()._apply(fn, *args, **kwargs)
+
+    def train(self, mode: bool = True):
+        self.clear_cam_encoder_stack()
+        return super().train(mode)
+
+    def clear_cam_encoder_stack(self):
+        self._cam_encoder_stack = None
+
     def patchify(self, x: torch.Tensor):
         x = self.patch_embedding(x)
         grid_size = x.shape[2:]
@@ -340,6 +357,26 @@ class WanModel(torch.nn.Module):
             x=self.patch_size[0], y=self.patch_size[1], z=self.patch_size[2]
         )
 
+    def stacked_cam_encoder(self):
+        # 各 block 的 cam_encoder 权重堆叠为 [num_blocks, dim, 12] / [num_blocks, dim]
+        # 训练（或需要梯度）时每次在 forward 内 torch.stack，可微且总是最新；推理时复用缓存，cam_encoder 被替换时重建
+        encoders = tuple(block.cam_encoder for block in self.blocks)
+        if self.training or torch.is_grad_enabled():
+            return torch.stack([m.weight for m in encoders]), torch.stack([m.bias for m in encoders])
+        cached = self._cam_encoder_stack
+        if cached is None or any(a is not b for a, b in zip(cached[0], encoders)):
+            weight = torch.stack([m.weight for m in encoders])
+            bias = torch.stack([m.bias for m in encoders])
+            self._cam_encoder_stack = cached = (encoders, weight, bias)
+        return cached[1], cached[2]
+
+    def encode_cameras(self, cam_emb: torch.Tensor):
+        # 🔧 把所有 block 的 cam_encoder (Linear(12, dim)) 合并为一次 batched GEMM -> [num_blocks, batch, frames, dim]
+        # projector 作用在各 block 自己的 self-attn 输出上，依赖前一个 block 的结果，无法跨 block 合并
+        weight, bias = self.stacked_cam_encoder()
+        cam_emb = cam_emb.to(weight.dtype)
+        return torch.einsum('ndk,btk->nbtd', weight, cam_emb) + bias[:, None, None, :]
+
     def forward(self,
                 x: torch.Tensor,
                 timestep: torch.Tensor,
@@ -362,6 +399,9 @@ class WanModel(torch.nn.Module):
             context = torch.cat([clip_embdding, context], dim=1)
         
         x, (f, h, w) = self.patchify(x)
+
+        # 🔧 所有 block 的 cam_encoder 一次批量计算: [num_blocks, batch, frames, dim]
+        cam_embs = self.encode_cameras(cam_emb) if cam_emb is not None else [None] * len(self.blocks)
         
         freqs = torch.cat([
             self.freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
@@ -374,23 +414,23 @@ class WanModel(torch.nn.Module):
                 return module(*inputs)
             return custom_forward
 
-        for block in self.blocks:
+        for block, block_cam_emb in zip(self.blocks, cam_embs):
             if self.training and use_gradient_checkpointing:
                 if use_gradient_checkpointing_offload:
                     with torch.autograd.graph.save_on_cpu():
                         x = torch.utils.checkpoint.checkpoint(
                             create_custom_forward(block),
-                            x, context, cam_emb, t_mod, freqs,
+                            x, context, block_cam_emb, t_mod, freqs, True,
                             use_reentrant=False,
                         )
                 else:
                     x = torch.utils.checkpoint.checkpoint(
                         create_custom_forward(block),
-                        x, context, cam_emb, t_mod, freqs,
+                        x, context, block_cam_emb, t_mod, freqs, True,
                         use_reentrant=False,
                     )
             else:
-                x = block(x, context, cam_emb, t_mod, freqs)
+                x = block(x, context, block_cam_emb, t_mod, freqs, cam_emb_encoded=True)
 
         x = self.head(x, t)
         x = self.unpatchify(x, (f, h, w))
@@ -1,9 +1,11 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import os
 import math
-import numpy as np
-from typing import Tuple, Optional
+import warnings
+import functools
+from typing import Tuple, Optional, Union
 from einops import rearrange
 from .utils import hash_state_dict_keys
 try:
@@ -23,49 +25,159 @@ try:
     SAGE_ATTN_AVAILABLE = True
 except ModuleNotFoundError:
     SAGE_ATTN_AVAILABLE = False
+
+try:
+    from torch.nn.attention import sdpa_kernel, SDPBackend
+    # only the fused kernels; the O(n^2)-memory math kernel is an explicit, logged fallback in sdpa()
+    SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+except ImportError:
+    sdpa_kernel = None
     
     
+def _split_heads(t: torch.Tensor, num_heads: int):
+    # b s (n d) -> b s n d
+    return t.view(t.shape[0], t.shape[1], num_heads, -1)
+
+
+def _merge_heads(t: torch.Tensor):
+    # b s n d -> b s (n d)
+    return t.reshape(t.shape[0], t.shape[1], -1)
+
+
+# Tensor layout expected by the attention backend: FA2/FA3 take b s n d, SDPA/sage take b n s d.
+# Q/K/V are brought into this layout once (rope_apply already returns it), so no per-call shuffling is needed.
+ATTN_LAYOUT = "bsnd" if (FLASH_ATTN_3_AVAILABLE or FLASH_ATTN_2_AVAILABLE) else "bnsd"
+
+
+def to_attn_layout(t: torch.Tensor, num_heads: int):
+    # b s (n d) -> ATTN_LAYOUT; tensors that are already split are returned unchanged
+    if t.dim() == 4:
+        return t
+    t = _split_heads(t, num_heads)
+    return t if ATTN_LAYOUT == "bsnd" else t.transpose(1, 2)
+
+
+def check_head_dim(head_dim: int):
+    # FA2/FA3 and the fused SDPA kernels need head_dim % 8 == 0 and head_dim <= 256;
+    # anything else silently lands on the quadratic math backend.
+    assert head_dim % 8 == 0 and head_dim <= 256, \
+        f"head_dim={head_dim} is not supported by the fused attention kernels (need a multiple of 8, <= 256)"
+
+
+_SDPA_MATH_FALLBACK_WARNED = False
+
+
+def sdpa(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, causal=False):
+    if sdpa_kernel is None:
+        return F.scaled_dot_product_attention(q, k, v, is_causal=causal)
+    try:
+        with sdpa_kernel(SDPA_BACKENDS):
+            return F.scaled_dot_product_attention(q, k, v, is_causal=causal)
+    except RuntimeError as e:
+        # no fused kernel for this shape/dtype/device (e.g. fp32 or CPU runs): fall back to math, but say so once
+        global _SDPA_MATH_FALLBACK_WARNED
+        if not _SDPA_MATH_FALLBACK_WARNED:
+            warnings.warn(f"Fused SDPA kernels unavailable for q={tuple(q.shape)} {q.dtype} on {q.device}; "
+                          f"falling back to the math backend ({e})")
+            _SDPA_MATH_FALLBACK_WARNED = True
+        with sdpa_kernel([SDPBackend.MATH]):
+            return F.scaled_dot_product_attention(q, k, v, is_causal=causal)
+
+
+def compiler_disable(fn):
+    # keep torch.compile from tracing into the external attention kernels when blocks are compiled
+    if hasattr(torch, "compiler") and hasattr(torch.compiler, "disable"):
+        return torch.compiler.disable(fn)
+    return fn
+
+
+@compiler_disable
+def external_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, causal=False):
+    # FA3/FA2 in bsnd layout, sage in bnsd layout
+    if ATTN_LAYOUT == "bsnd":
+        if FLASH_ATTN_3_AVAILABLE:
+            return flash_attn_interface.flash_attn_func(q, k, v, causal=causal)
+        return flash_attn.flash_attn_func(q, k, v, causal=causal)
+    return sageattn(q.contiguous(), k.contiguous(), v.contiguous(), is_causal=causal)
+
+
 def flash_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, num_heads: int, compatibility_mode=False, causal=False):
-    if compatibility_mode:
-        q = rearrange(q, "b s (n d) -> b n s d", n=num_heads)
-        k = rearrange(k, "b s (n d) -> b n s d", n=num_heads)
-        v = rearrange(v, "b s (n d) -> b n s d", n=num_heads)
-        x = F.scaled_dot_product_attention(q, k, v)
-        x = rearrange(x, "b n s d -> b s (n d)", n=num_heads)
-    elif FLASH_ATTN_3_AVAILABLE:
-        q = rearrange(q, "b s (n d) -> b s n d", n=num_heads)
-        k = rearrange(k, "b s (n d) -> b s n d", n=num_heads)
-        v = rearrange(v, "b s (n d) -> b s n d", n=num_heads)
-        x = flash_attn_interface.flash_attn_func(q, k, v)
-        x = rearrange(x, "b s n d -> b s (n d)", n=num_heads)
-    elif FLASH_ATTN_2_AVAILABLE:
-        q = rearrange(q, "b s (n d) -> b s n d", n=num_heads)
-        k = rearrange(k, "b s (n d) -> b s n d", n=num_heads)
-        v = rearrange(v, "b s (n d) -> b s n d", n=num_heads)
-        x = flash_attn.flash_attn_func(q, k, v)
-        x = rearrange(x, "b s n d -> b s (n d)", n=num_heads)
-    elif SAGE_ATTN_AVAILABLE:
-        q = rearrange(q, "b s (n d) -> b n s d", n=num_heads)
-        k = rearrange(k, "b s (n d) -> b n s d", n=num_heads)
-        v = rearrange(v, "b s (n d) -> b n s d", n=num_heads)
-        x = sageattn(q, k, v)
-        x = rearrange(x, "b n s d -> b s (n d)", n=num_heads)
+    q = to_attn_layout(q, num_heads)
+    k = to_attn_layout(k, num_heads)
+    v = to_attn_layout(v, num_heads)
+    if ATTN_LAYOUT == "bsnd":
+        if compatibility_mode:
+            x = sdpa(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), causal=causal)
+            x = x.transpose(1, 2)
+        else:
+            x = external_attention(q, k, v, causal=causal)
     else:
-        q = rearrange(q, "b s (n d) -> b n s d", n=num_heads)
-        k = rearrange(k, "b s (n d) -> b n s d", n=num_heads)
-        v = rearrange(v, "b s (n d) -> b n s d", n=num_heads)
-        x = F.scaled_dot_product_attention(q, k, v)
-        x = rearrange(x, "b n s d -> b s (n d)", n=num_heads)
-    return x
+        if SAGE_ATTN_AVAILABLE and not compatibility_mode:
+            x = external_attention(q, k, v, causal=causal)
+        else:
+            x = sdpa(q, k, v, causal=causal)
+        x = x.transpose(1, 2)
+    return _merge_heads(x)
+
+
+def cast_to(x: torch.Tensor, dtype: torch.dtype):
+    # Skip the .to() dispatch entirely on the common path where module dtypes already agree.
+    return x if x.dtype == dtype else x.to(dtype)
+
+
+def cast_like(x: torch.Tensor, ref: torch.Tensor):
+    # Same as x.to(ref) but skips the dispatch when nothing changes; H2D copies are issued non_blocking
+    # so a pinned CPU input overlaps with the GPU work already queued.
+    if x.dtype == ref.dtype and x.device == ref.device:
+        return x
+    return x.to(dtype=ref.dtype, device=ref.device, non_blocking=x.device.type == "cpu")
 
 
 def modulate(x: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor):
     return (x * (1 + scale) + shift)
 
 
+def _norm_modulate(x: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor, eps: float):
+    return F.layer_norm(x, (x.shape[-1],), None, None, eps) * (1 + scale) + shift
+
+
+# Opt-in: the fused elementwise helpers below (norm_modulate, rope_apply, ffn_apply, build_scale_camera) run eager
+# unless DIFFSYNTH_COMPILE_ELEMENTWISE_OPS=1 is set or enable_elementwise_compile() is called, since they need a
+# working Inductor/Triton and recompile for new shapes.
+COMPILE_ELEMENTWISE_OPS = os.environ.get("DIFFSYNTH_COMPILE_ELEMENTWISE_OPS", "0") == "1" and hasattr(torch, "compile")
+
+
+def enable_elementwise_compile(enabled: bool = True):
+    global COMPILE_ELEMENTWISE_OPS
+    COMPILE_ELEMENTWISE_OPS = enabled and hasattr(torch, "compile")
+
+
+def maybe_compile(fn):
+    # torch.compile is lazy, so wrapping costs nothing until the compiled path is actually taken
+    return torch.compile(fn, dynamic=True) if hasattr(torch, "compile") else fn
+
+
+_norm_modulate_fused = maybe_compile(_norm_modulate)
+
+
+def norm_modulate(norm: nn.LayerNorm, x: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor):
+    # Equivalent to modulate(norm(x), shift, scale) for a LayerNorm without affine parameters,
+    # but lets Inductor read x once and emit the normalized+modulated tensor in a single kernel.
+    if COMPILE_ELEMENTWISE_OPS and x.is_cuda:
+        return _norm_modulate_fused(x, shift, scale, norm.eps)
+    return _norm_modulate(x, shift, scale, norm.eps)
+
+
+@functools.lru_cache(maxsize=None)
+def _sinusoidal_inv_freq(dim: int, device: torch.device):
+    # only the frequency vector is memoized; it depends on (dim, device), never on timestep values
+    return torch.pow(10000, -torch.arange(dim//2, dtype=torch.float32, device=device).div(dim//2))
+
+
 def sinusoidal_embedding_1d(dim, position):
-    sinusoid = torch.outer(position.type(torch.float64), torch.pow(
-        10000, -torch.arange(dim//2, dtype=torch.float64, device=position.device).div(dim//2)))
+    # float32 is enough here: theta=10000 and dim<=256, and the result is cast down anyway.
+    # Computed on position.device, so there is no host sync and no H2D copy per step.
+    sinusoid = torch.outer(position.to(torch.float32), _sinusoidal_inv_freq(dim, position.device))
     x = torch.cat([torch.cos(sinusoid), torch.sin(sinusoid)], dim=1)
     return x.to(position.dtype)
 
@@ -83,16 +195,73 @@ def precompute_freqs_cis(dim: int, end: int = 1024, theta: float = 10000.0):
     freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)
                    [: (dim // 2)].double() / dim))
     freqs = torch.outer(torch.arange(end, device=freqs.device), freqs)
-    freqs_cis = torch.polar(torch.ones_like(freqs), freqs)  # complex64
-    return freqs_cis
+    freqs_cis = torch.polar(torch.ones_like(freqs), freqs)
+    # store as real (cos, sin) pairs so nothing downstream carries a complex dtype
+    return torch.view_as_real(freqs_cis).float().contiguous()  # [end, dim // 2, 2]
+
+
+def _rope_apply(x, freqs, num_heads):
+    # freqs: [..., head_dim // 2, 2] real tensor holding (cos, sin)
+    x_pair = _split_heads(x, num_heads).float().unflatten(-1, (-1, 2))
+    x_even, x_odd = x_pair.unbind(-1)
+    cos, sin = freqs.unbind(-1)
+    x_out = torch.stack((x_even * cos - x_odd * sin, x_even * sin + x_odd * cos), dim=-1).flatten(-2)
+    if ATTN_LAYOUT == "bnsd":
+        x_out = x_out.transpose(1, 2).contiguous()
+    return x_out.to(x.dtype)  # [b, s, n, d] or [b, n, s, d] according to ATTN_LAYOUT
+
+
+_rope_apply_fused = maybe_compile(_rope_apply)
 
 
 def rope_apply(x, freqs, num_heads):
-    x = rearrange(x, "b s (n d) -> b s n d", n=num_heads)
-    x_out = torch.view_as_complex(x.to(torch.float64).reshape(
-        x.shape[0], x.shape[1], x.shape[2], -1, 2))
-    x_out = torch.view_as_real(x_out * freqs).flatten(2)
-    return x_out.to(x.dtype)
+    if COMPILE_ELEMENTWISE_OPS and x.is_cuda:
+        return _rope_apply_fused(x, freqs, num_heads)
+    return _rope_apply(x, freqs, num_heads)
+
+
+def _gelu_mlp(x, w1, b1, w2, b2):
+    return F.linear(F.gelu(F.linear(x, w1, b1), approximate="tanh"), w2, b2)
+
+
+_gelu_mlp_fused = maybe_compile(_gelu_mlp)
+
+
+def ffn_apply(ffn: nn.Sequential, x: torch.Tensor):
+    # ffn is Sequential(Linear, GELU(tanh), Linear); compiling it as a function of the weights lets
+    # Inductor fold the GELU into the first GEMM's epilogue while keeping the `ffn.0`/`ffn.2` state_dict keys.
+    if COMPILE_ELEMENTWISE_OPS and x.is_cuda:
+        return _gelu_mlp_fused(x, ffn[0].weight, ffn[0].bias, ffn[2].weight, ffn[2].bias)
+    return ffn(x)
+
+
+# Pure tensor-in/tensor-out pieces of WanModelMoe.process_input_hidden_states. Everything data-dependent
+# (masking out -1 indices, .item() on start indices) stays in the eager caller, so these compile without graph breaks.
+def _assemble_rope(f_freqs: torch.Tensor, hw_freqs: torch.Tensor, t_indices: torch.Tensor):
+    B, num_frames = t_indices.shape
+    # 一次index_select取出所有帧的时间频率
+    f_sel = f_freqs.index_select(0, t_indices.reshape(-1)).view(B, num_frames, -1, 2)  # [B, F, Df, 2]
+    rope_freqs = torch.cat([
+        f_sel[:, :, None].expand(-1, -1, hw_freqs.shape[0], -1, -1),
+        hw_freqs[None, None].expand(B, num_frames, -1, -1, -1)
+    ], dim=-2)
+    return rope_freqs.reshape(B, -1, rope_freqs.shape[-2], 2)
+
+
+def _scale_camera(cam_emb: torch.Tensor, valid_indices: torch.Tensor, num_frames: int, h: int, w: int, start_indice: int):
+    rel = valid_indices[:num_frames].to(device=cam_emb.device, dtype=torch.long) - start_indice
+    if rel.shape[0] < num_frames:
+        # 没有有效索引的帧指向-1，下面会被mask成0
+        rel = torch.cat([rel, rel.new_full((num_frames - rel.shape[0],), -1)])
+    valid_mask = (rel >= 0) & (rel < cam_emb.shape[1])
+    safe_rel = rel.clamp(0, cam_emb.shape[1] - 1)
+    # 一次gather直接得到[B, F, cam_dim]，再原地mask；不再先zeros再逐帧覆盖
+    camera = cam_emb.index_select(1, safe_rel).mul_(valid_mask.view(1, -1, 1).to(cam_emb.dtype))
+    camera_spatial = camera.unsqueeze(2).unsqueeze(3).expand(-1, -1, h, w, -1)
+    return camera_spatial.reshape(camera.shape[0], -1, camera.shape[-1])  # b f h w d -> b (f h w) d
+
+
+_scale_camera_fused = maybe_compile(_scale_camera)
 
 
 class RMSNorm(nn.Module):
@@ -105,18 +274,46 @@ class RMSNorm(nn.Module):
         return x * torch.rsqrt(x.pow(2).mean(dim=-1, keepdim=True) + self.eps)
 
     def forward(self, x):
+        if hasattr(F, "rms_norm"):
+            # torch>=2.4: single fused kernel, accumulates in fp32 internally
+            return F.rms_norm(x, (x.shape[-1],), self.weight, self.eps)
         dtype = x.dtype
         return self.norm(x.float()).to(dtype) * self.weight
 
 
-class AttentionModule(nn.Module):
-    def __init__(self, num_heads, causal=False):
-        super().__init__()
-        self.num_heads = num_heads
-        
-    def forward(self, q, k, v):
-        x = flash_attention(q=q, k=k, v=v, num_heads=self.num_heads)
-        return x
+def fuse_linear_state_dict(state_dict, prefix, source_names, target_name):
+    # Checkpoints store separate projections (e.g. q/k/v); concatenate them into the fused Linear.
+    for param_name in ("weight", "bias"):
+        keys = [f"{prefix}{name}.{param_name}" for name in source_names]
+        if all(key in state_dict for key in keys):
+            state_dict[f"{prefix}{target_name}.{param_name}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+
+# Fused Linear -> the separate projections it replaces, in checkpoint order.
+FUSED_LINEAR_SPLITS = {
+    "self_attn.qkv": ("self_attn.q", "self_attn.k", "self_attn.v"),
+    "cross_attn.kv": ("cross_attn.k", "cross_attn.v"),
+    "cross_attn.kv_img": ("cross_attn.k_img", "cross_attn.v_img"),
+}
+
+
+def unfuse_linear_state_dict(state_dict):
+    """Inverse of the load-time fusion: WanModelMoe.state_dict() carries fused qkv / kv / kv_img keys, which the
+    unfused DiTs (wan_video_dit.py, wan_video_dit_recam_future.py, ...) and external tools cannot read. The MoE
+    train scripts pass their checkpoints through this before saving, so files on disk keep the original
+    q/k/v layout; WanModelMoe itself loads either layout."""
+    converted = {}
+    for name, param in state_dict.items():
+        module_name, _, param_name = name.rpartition(".")
+        fused_name = next((f for f in FUSED_LINEAR_SPLITS if module_name == f or module_name.endswith("." + f)), None)
+        if fused_name is None:
+            converted[name] = param
+            continue
+        module_prefix = module_name[:len(module_name) - len(fused_name)]
+        split_names = FUSED_LINEAR_SPLITS[fused_name]
+        for split_name, chunk in zip(split_names, param.chunk(len(split_names), dim=0)):
+            converted[f"{module_prefix}{split_name}.{param_name}"] = chunk.clone()
+    return converted
 
 
 class SelfAttention(nn.Module):
@@ -125,24 +322,27 @@ class SelfAttention(nn.Module):
         self.dim = dim
         self.num_heads = num_heads
         self.head_dim = dim // num_heads
+        check_head_dim(self.head_dim)
 
-        self.q = nn.Linear(dim, dim)
-        self.k = nn.Linear(dim, dim)
-        self.v = nn.Linear(dim, dim)
+        self.qkv = nn.Linear(dim, dim * 3)
         self.o = nn.Linear(dim, dim)
         self.norm_q = RMSNorm(dim, eps=eps)
         self.norm_k = RMSNorm(dim, eps=eps)
+        self.causal = causal
         
-        self.attn = AttentionModule(self.num_heads)
+        self.register_load_state_dict_pre_hook(self._load_legacy_qkv)
+
+    def _load_legacy_qkv(self, module, state_dict, prefix, *args):
+        fuse_linear_state_dict(state_dict, prefix, ("q", "k", "v"), "qkv")
 
     def forward(self, x, freqs):
-        x = x.to(self.q.weight.dtype)
-        q = self.norm_q(self.q(x))
-        k = self.norm_k(self.k(x))
-        v = self.v(x)
+        x = cast_to(x, self.qkv.weight.dtype)
+        q, k, v = self.qkv(x).chunk(3, dim=-1)
+        q = self.norm_q(q)
+        k = self.norm_k(k)
         q = rope_apply(q, freqs, self.num_heads)
         k = rope_apply(k, freqs, self.num_heads)
-        x = self.attn(q, k, v)
+        x = flash_attention(q, k, v, num_heads=self.num_heads, causal=self.causal)
         return self.o(x)
 
 
@@ -152,20 +352,23 @@ class CrossAttention(nn.Module):
         self.dim = dim
         self.num_heads = num_heads
         self.head_dim = dim // num_heads
+        check_head_dim(self.head_dim)
 
         self.q = nn.Linear(dim, dim)
-        self.k = nn.Linear(dim, dim)
-        self.v = nn.Linear(dim, dim)
+        self.kv = nn.Linear(dim, dim * 2)
         self.o = nn.Linear(dim, dim)
         self.norm_q = RMSNorm(dim, eps=eps)
         self.norm_k = RMSNorm(dim, eps=eps)
         self.has_image_input = has_image_input
         if has_image_input:
-            self.k_img = nn.Linear(dim, dim)
-            self.v_img = nn.Linear(dim, dim)
+            self.kv_img = nn.Linear(dim, dim * 2)
             self.norm_k_img = RMSNorm(dim, eps=eps)
             
-        self.attn = AttentionModule(self.num_heads)
+        self.register_load_state_dict_pre_hook(self._load_legacy_kv)
+
+    def _load_legacy_kv(self, module, state_dict, prefix, *args):
+        fuse_linear_state_dict(state_dict, prefix, ("k", "v"), "kv")
+        fuse_linear_state_dict(state_dict, prefix, ("k_img", "v_img"), "kv_img")
 
     def forward(self, x: torch.Tensor, y: torch.Tensor):
         if self.has_image_input:
@@ -173,13 +376,13 @@ class CrossAttention(nn.Module):
             ctx = y[:, 257:]
         else:
             ctx = y
-        q = self.norm_q(self.q(x))
-        k = self.norm_k(self.k(ctx))
-        v = self.v(ctx)
-        x = self.attn(q, k, v)
+        q = to_attn_layout(self.norm_q(self.q(x)), self.num_heads)  # shared by the text and image attention
+        k, v = self.kv(ctx).chunk(2, dim=-1)
+        k = self.norm_k(k)
+        x = flash_attention(q, k, v, num_heads=self.num_heads)
         if self.has_image_input:
-            k_img = self.norm_k_img(self.k_img(img))
-            v_img = self.v_img(img)
+            k_img, v_img = self.kv_img(img).chunk(2, dim=-1)
+            k_img = self.norm_k_img(k_img)
             y = flash_attention(q, k_img, v_img, num_heads=self.num_heads)
             x = x + y
         return self.o(x)
@@ -212,12 +415,12 @@ class ModalityProcessor(nn.Module):
             x = x.unsqueeze(1)  # [batch, 1, input_dim]
         
         # 🔧 关键修复：确保数据类型匹配projector的权重类型
-        x = x.to(self.projector[0].weight.dtype)
+        x = cast_to(x, self.projector[0].weight.dtype)
         
         output = self.projector(x)
         
         # 🔧 可选：保持原始数据类型
-        output = output.to(original_dtype)
+        output = cast_to(output, original_dtype)
         
         return output
 
@@ -248,14 +451,16 @@ class MultiModalMoE(nn.Module):
                 nn.Linear(unified_dim, self.output_dim)
             ) for _ in range(num_experts)
         ])
+        # 训练时总是收集专家统计信息；推理时默认不收集，需stats_enabled
+        self.stats_enabled = False
         
-    def forward(self, x: torch.Tensor, expert_weights: torch.Tensor, top_k_indices: torch.Tensor, 
+    def forward(self, x: torch.Tensor, expert_weights: Optional[torch.Tensor], top_k_indices: Union[torch.Tensor, int], 
                 modality_type: str = "unknown") -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Args:
             x: [batch_size, seq_len, unified_dim]
-            expert_weights: [batch_size, seq_len, top_k] - 从全局router得到的权重
-            top_k_indices: [batch_size, seq_len, top_k] - 从全局router得到的专家索引
+            expert_weights: [batch_size, seq_len, top_k] - 从全局router得到的权重; None表示确定性单专家路由
+            top_k_indices: [batch_size, seq_len, top_k] - 从全局router得到的专家索引; 或单个专家id (int)
             modality_type: 模态类型标识（用于专家分配和统计）
         Returns:
             output: [batch_size, seq_len, output_dim]
@@ -266,7 +471,7 @@ class MultiModalMoE(nn.Module):
         
         # 🔧 修正：确保数据类型匹配
         original_dtype = x.dtype
-        x = x.to(self.experts[0][0].weight.dtype)
+        x = cast_to(x, self.experts[0][0].weight.dtype)
         
         # 🔧 获取该模态应该使用的目标专家
         target_expert_id = self.modality_to_expert.get(modality_type, 0)
@@ -274,71 +479,91 @@ class MultiModalMoE(nn.Module):
         # 🔧 收集专家选择统计信息
         expert_stats = self.collect_expert_statistics(expert_weights, top_k_indices, modality_type, target_expert_id)
         
-        # Expert processing (使用当前层的独立experts)
-        expert_outputs = []
-        for expert in self.experts:
-            expert_output = expert(x)  # [batch, seq, output_dim]
-            expert_outputs.append(expert_output)
-        
-        expert_outputs = torch.stack(expert_outputs, dim=-2)  # [batch, seq, num_experts, output_dim]
+        # 🔧 确定性单专家路由：只运行被选中的专家，权重恒为1
+        if expert_weights is None:
+            output = self.experts[top_k_indices](x)
+            return cast_to(output, original_dtype), expert_stats
         
-        # Weighted combination using provided weights and indices
-        output = torch.zeros(batch_size, seq_len, self.output_dim, 
-                           device=x.device, dtype=x.dtype)
+        # top_k > 1 时走这里：WanModelMoe.compute_router_decisions 返回 [B, S, top_k] 的权重/索引张量，
+        # 即 train_moe*.py / infer_moe*.py 传 --moe_top_k 2 (或更大) 时；默认 --moe_top_k 1 只走上面的单专家分支
+        # Expert processing (使用当前层的独立experts) - 所有专家输入相同，合并为一次batched GEMM
+        # 权重仍保存在self.experts中（兼容checkpoint），这里只在前向时stack
+        expert_weight = torch.stack([expert[0].weight for expert in self.experts])  # [num_experts, output_dim, unified_dim]
+        expert_bias = torch.stack([expert[0].bias for expert in self.experts])  # [num_experts, output_dim]
+        expert_outputs = torch.einsum("bsd,eod->bseo", x, expert_weight) + expert_bias  # [batch, seq, num_experts, output_dim]
         
-        for k in range(self.top_k):
-            expert_idx = top_k_indices[:, :, k]  # [batch, seq]
-            weight = expert_weights[:, :, k:k+1]  # [batch, seq, 1]
-            
-            expert_output = torch.gather(
-                expert_outputs, 
-                dim=2, 
-                index=expert_idx.unsqueeze(-1).unsqueeze(-1).expand(-1, -1, 1, expert_outputs.shape[-1])
-            ).squeeze(2)  # [batch, seq, output_dim]
-            
-            output += weight * expert_output
+        # Weighted combination using provided weights and indices - gather all top-k experts at once
+        gather_index = top_k_indices.unsqueeze(-1).expand(-1, -1, -1, expert_outputs.shape[-1])
+        selected_outputs = torch.gather(expert_outputs, dim=2, index=gather_index)  # [batch, seq, top_k, output_dim]
+        output = (selected_outputs * expert_weights.unsqueeze(-1).to(selected_outputs.dtype)).sum(dim=2)
         
         # 🔧 恢复原始数据类型
-        output = output.to(original_dtype)
+        output = cast_to(output, original_dtype)
         
         return output, expert_stats
     
     def collect_expert_statistics(self, expert_weights, top_k_indices, modality_type, target_expert_id):
-        """🔧 收集专家选择统计信息"""
+        """🔧 收集专家选择统计信息（训练模式下，或开启stats_enabled时，见WanModelMoe.enable_expert_stats）"""
+        if not (self.training or self.stats_enabled):
+            return None
+        if expert_weights is None:
+            # 确定性路由：所有token都以权重1选择专家 top_k_indices
+            selection_ratio = torch.zeros(self.num_experts)
+            selection_ratio[top_k_indices] = 1.0
+            return {
+                'modality_type': modality_type,
+                'target_expert_id': target_expert_id,
+                'target_expert_usage': float(top_k_indices == target_expert_id),
+                'expert_selection_ratio': selection_ratio,
+                'avg_expert_weights': selection_ratio.clone(),
+                'avg_top_k_weights': torch.ones(1),
+                'num_experts': self.num_experts,
+                'top_k': self.top_k
+            }
         with torch.no_grad():
-            # 计算每个专家被选中的频率
-            expert_selection_count = torch.zeros(self.num_experts, device=expert_weights.device)
-            for expert_id in range(self.num_experts):
-                expert_selection_count[expert_id] = (top_k_indices == expert_id).float().sum()
-            
-            total_selections = expert_selection_count.sum()
-            expert_selection_ratio = expert_selection_count / (total_selections + 1e-8)
-            
-            # 计算平均权重
-            avg_expert_weights = torch.zeros(self.num_experts, device=expert_weights.device)
-            for expert_id in range(self.num_experts):
-                mask = (top_k_indices == expert_id)
-                if mask.sum() > 0:
-                    avg_expert_weights[expert_id] = expert_weights[mask].mean()
+            # 计算每个专家被选中的次数和权重总和 (scatter_add, 与专家数量无关的kernel数)
+            flat_indices = top_k_indices.reshape(-1)
+            flat_weights = expert_weights.reshape(-1).float()
+            expert_selection_count = torch.zeros(self.num_experts, device=expert_weights.device, dtype=torch.float32)
+            expert_selection_count.scatter_add_(0, flat_indices, torch.ones_like(flat_weights))
+            expert_weight_sum = torch.zeros_like(expert_selection_count).scatter_add_(0, flat_indices, flat_weights)
             
+            expert_selection_ratio = expert_selection_count / (expert_selection_count.sum() + 1e-8)
+            # 计算平均权重（未被选中的专家为0）
+            avg_expert_weights = expert_weight_sum / expert_selection_count.clamp(min=1)
             # 计算Top-K权重统计
-            avg_top_k_weights = expert_weights.mean(dim=(0, 1))
+            avg_top_k_weights = expert_weights.float().mean(dim=(0, 1))
             
-            # 🔧 计算目标专家的使用率
-            target_expert_usage = expert_selection_ratio[target_expert_id].item()
-            
-            # 返回统计信息字典
+            # 返回统计信息字典 - 保持在device上，不在forward里同步；打印时再统一拷回host
             return {
                 'modality_type': modality_type,
                 'target_expert_id': target_expert_id,
-                'target_expert_usage': target_expert_usage,
-                'expert_selection_ratio': expert_selection_ratio.float().cpu().numpy(),
-                'avg_expert_weights': avg_expert_weights.float().cpu().numpy(),
-                'avg_top_k_weights': avg_top_k_weights.float().cpu().numpy(),
+                'target_expert_usage': expert_selection_ratio[target_expert_id],
+                'expert_selection_ratio': expert_selection_ratio,
+                'avg_expert_weights': avg_expert_weights,
+                'avg_top_k_weights': avg_top_k_weights,
                 'num_experts': self.num_experts,
                 'top_k': self.top_k
             }
                                     
+def combine_modality_inputs(modality_inputs: dict):
+    """🔧 合并各模态输入，返回 (combined_input, 最后一个活跃模态)；单模态时直接透传，不产生临时tensor"""
+    if not modality_inputs:
+        return None, "unknown"
+    active_modality = next(reversed(modality_inputs))
+    if len(modality_inputs) == 1:
+        return next(iter(modality_inputs.values())), active_modality
+    # 多模态时一次reduction代替K-1次相加
+    return torch.stack(list(modality_inputs.values()), dim=0).sum(0), active_modality
+
+
+def mean_of_stats(values):
+    # 专家统计量可能是device tensor或python float；统一stack后在原device上求均值，最后只做一次拷贝
+    values = [torch.as_tensor(value) for value in values]
+    device = values[0].device
+    return torch.stack([value.to(device=device, dtype=torch.float32) for value in values]).mean(0).cpu()
+
+
 class DiTBlockWithMoE(nn.Module):
     """集成MoE的DiT Block"""
     
@@ -377,23 +602,18 @@ class DiTBlockWithMoE(nn.Module):
     def forward(self, x, context, cam_emb, t_mod, freqs, 
                 modality_inputs: Optional[dict] = None,
                 router_weights: Optional[torch.Tensor] = None,
-                router_indices: Optional[torch.Tensor] = None):
-        # 原有的modulation
-        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (
-            self.modulation.to(dtype=t_mod.dtype, device=t_mod.device) + t_mod).chunk(6, dim=1)
-        input_x = modulate(self.norm1(x), shift_msa, scale_msa)
+                router_indices: Optional[Union[torch.Tensor, int]] = None,
+                modulation: Optional[Tuple[torch.Tensor, ...]] = None):
+        # 原有的modulation (可由WanModelMoe.precompute_modulation为所有block一次性算好)
+        if modulation is None:
+            modulation = (self.modulation.to(dtype=t_mod.dtype, device=t_mod.device) + t_mod).chunk(6, dim=1)
+        shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = modulation
+        input_x = norm_modulate(self.norm1, x, shift_msa, scale_msa)
 
         # 🔧 MoE处理 - 使用全局router的结果
-        if self.use_moe and modality_inputs and hasattr(self, 'moe') and router_weights is not None:
+        if self.use_moe and modality_inputs and hasattr(self, 'moe') and router_indices is not None:
             # 合并所有模态的输入（已经通过全局processor处理过）
-            combined_modality_input = None
-            active_modality = "unknown"
-            for modality_type, processed_input in modality_inputs.items():
-                active_modality = modality_type  # 记录当前活跃的模态
-                if combined_modality_input is None:
-                    combined_modality_input = processed_input
-                else:
-                    combined_modality_input = combined_modality_input + processed_input
+            combined_modality_input, active_modality = combine_modality_inputs(modality_inputs)
             
             if combined_modality_input is not None:
                 # 🔧 使用全局router的权重和索引
@@ -406,27 +626,28 @@ class DiTBlockWithMoE(nn.Module):
                 input_x = input_x + moe_output
                 
                 # 🔧 存储专家统计信息供后续收集
-                if not hasattr(self, 'expert_stats_buffer'):
-                    self.expert_stats_buffer = []
-                    
-                self.expert_stats_buffer.append(expert_stats)
+                if expert_stats is not None:
+                    if not hasattr(self, 'expert_stats_buffer'):
+                        self.expert_stats_buffer = []
+                        
+                    self.expert_stats_buffer.append(expert_stats)
         elif cam_emb is not None and hasattr(self, 'cam_encoder'):
             # 传统camera编码器作为fallback
-            cam_emb = cam_emb.to(self.cam_encoder.weight.dtype)
+            cam_emb = cast_to(cam_emb, self.cam_encoder.weight.dtype)
             cam_emb = self.cam_encoder(cam_emb)
             input_x = input_x + cam_emb
 
-        input_x = input_x.to(self.projector.weight.dtype)
+        input_x = cast_to(input_x, self.projector.weight.dtype)
 
         # Ensure self.self_attn output dtype matches self.projector.weight dtype
         attn_output = self.self_attn(input_x, freqs)
-        attn_output = attn_output.to(self.projector.weight.dtype)
+        attn_output = cast_to(attn_output, self.projector.weight.dtype)
 
         x = x + gate_msa * self.projector(attn_output)
-        x = x.to(self.norm3.weight.dtype)
+        x = cast_to(x, self.norm3.weight.dtype)
         x = x + self.cross_attn(self.norm3(x), context)
-        input_x = modulate(self.norm2(x), shift_mlp, scale_mlp)
-        x = x + gate_mlp * self.ffn(input_x)
+        input_x = norm_modulate(self.norm2, x, shift_mlp, scale_mlp)
+        x = x + gate_mlp * ffn_apply(self.ffn, input_x)
         return x
                 
 class MLP(torch.nn.Module):
@@ -475,7 +696,8 @@ class WanModelMoe(torch.nn.Module):
         has_image_input: bool,
         # 🔧 新增MoE参数
         use_moe: bool = True,
-        moe_config: Optional[dict] = None
+        moe_config: Optional[dict] = None,
+        compile_blocks: bool = False
     ):
         super().__init__()
         self.dim = dim
@@ -529,11 +751,132 @@ class WanModelMoe(torch.nn.Module):
         
         self.head = Head(dim, out_dim, patch_size, eps)
         head_dim = dim // num_heads
-        self.freqs = precompute_freqs_cis_3d(head_dim)
+        # (f, h, w) RoPE tables packed side by side into one contiguous [end, D/2, 2] table;
+        # self.freqs are views into it, so a device move is a single copy.
+        freqs = precompute_freqs_cis_3d(head_dim)
+        self._freqs_split = tuple(f.shape[1] for f in freqs)
+        self._freqs_packed = torch.cat(freqs, dim=1)
+        self.freqs = self._freqs_packed.split(self._freqs_split, dim=1)
+        # freqs are kept as plain attributes (not buffers) so that ModelManager's
+        # `.to(dtype=...)` never downcasts the fp32 tables; device copies are cached instead.
+        self._freqs_device_cache = {}
+        self._rope_cache = {}
+        self._rope_cache_size = 8
+        self._spatial_rope_cache = {}
+        self._rope_grid_cache = {}
+        self._rope_grid_cache_size = 6
+        # 推理用：所有block的modulation堆叠并cast到工作dtype/device后缓存；load_state_dict与.to()/.half()等之后失效
+        self._modulation_cache = None
+        self.register_load_state_dict_post_hook(lambda module, incompatible_keys: module.clear_modulation_cache())
 
         if has_image_input:
             self.img_emb = MLP(1280, dim)  # clip_feature_dim = 1280
 
+        # 🔧 推理时专家统计默认关闭 (训练模式下总是收集)：关闭时forward里不清空/不填充expert_stats_buffer
+        self.collect_expert_stats = False
+        # 🔧 调试检查 (如rope/hidden_states长度校验) 默认关闭
+        self._debug = False
+
+        if compile_blocks:
+            self.enable_block_compile()
+
+    def enable_expert_stats(self, enabled: bool = True):
+        """🔧 开关所有block的专家统计 (需在挂载moe之后调用)，配合print_overall_expert_statistics使用"""
+        self.collect_expert_stats = enabled
+        for block in self.blocks:
+            if hasattr(block, 'moe'):
+                block.moe.stats_enabled = enabled
+            block.expert_stats_buffer = []
+
+    def enable_block_compile(self, mode: Optional[str] = "reduce-overhead", dynamic: bool = False):
+        """🔧 torch.compile每个DiT block (原地编译，state_dict的key不变，之后挂载的cam_encoder/moe等也会生效)"""
+        if not hasattr(torch.nn.Module, "compile"):
+            print("⚠️ 当前torch版本不支持nn.Module.compile，跳过block编译")
+            return
+        # 默认按静态shape + CUDA graphs编译；序列长度随clean latents/滑动窗口变化时传dynamic=True避免反复重编译
+        for block in self.blocks:
+            block.compile(mode=mode, dynamic=dynamic, fullgraph=False)
+
+    def get_freqs(self, device):
+        """Return (f_freqs, h_freqs, w_freqs) on `device`, copying the packed table there only once."""
+        device = torch.device(device)
+        freqs = self._freqs_device_cache.get(device)
+        if freqs is None:
+            freqs = self._freqs_packed.to(device).split(self._freqs_split, dim=1)
+            self._freqs_device_cache[device] = freqs
+        return freqs
+
+    @staticmethod
+    def scale_rope_indices(valid_indices, num_frames, batch_size):
+        """Time indices of a downsampled clean scale -> [B, num_frames]; frames past the valid indices reuse the last one."""
+        t_indices = valid_indices[:num_frames]
+        t_indices = torch.cat([t_indices, t_indices[-1:].expand(num_frames - t_indices.shape[0])])
+        # 所有batch共用同一组索引
+        return t_indices.unsqueeze(0).expand(batch_size, -1)
+
+    def spatial_rope(self, h, w, device):
+        """The (h, w) half of the RoPE table -> [h*w, Dh+Dw, 2]; it does not depend on time, so it is built once per grid."""
+        key = (torch.device(device), h, w)
+        hw_freqs = self._spatial_rope_cache.get(key)
+        if hw_freqs is None:
+            _, h_freqs, w_freqs = self.get_freqs(device)
+            hw_freqs = torch.cat([
+                h_freqs[:h][:, None].expand(h, w, -1, 2),
+                w_freqs[:w][None, :].expand(h, w, -1, 2)
+            ], dim=-2).reshape(h * w, -1, 2)
+            self._spatial_rope_cache[key] = hw_freqs
+        return hw_freqs
+
+    def rope_grid(self, h, w, num_frames, device):
+        """Full RoPE table of an (h, w) grid for time indices < num_frames -> [T, h*w, D, 2].
+
+        Built lazily per grid with T rounded up to a power of two (capped at the table length), and
+        rebuilt only when a larger time index shows up. The few most recent grids are kept.
+        """
+        key = (torch.device(device), h, w)
+        grid = self._rope_grid_cache.pop(key, None)
+        if grid is None or grid.shape[0] < num_frames:
+            f_freqs = self.get_freqs(device)[0]
+            T = min(max(64, 1 << (num_frames - 1).bit_length()), f_freqs.shape[0])
+            t_indices = torch.arange(T, device=device).unsqueeze(0)
+            grid = _assemble_rope(f_freqs, self.spatial_rope(h, w, device), t_indices).view(T, h * w, -1, 2)
+        self._rope_grid_cache[key] = grid  # 重新插入到末尾 (LRU)
+        while len(self._rope_grid_cache) > self._rope_grid_cache_size:
+            self._rope_grid_cache.pop(next(iter(self._rope_grid_cache)))
+        return grid
+
+    def assemble_rope(self, t_indices, h, w, device):
+        """Build RoPE frequencies for a [B, F] grid of time indices -> [B, F*h*w, D, 2]."""
+        B, num_frames = t_indices.shape
+        # FramePack索引在CPU上，max()不会触发同步
+        grid = self.rope_grid(h, w, int(t_indices.max()) + 1, device)
+        t_indices = t_indices.to(device=device, dtype=torch.long)
+        return grid.index_select(0, t_indices.reshape(-1)).view(B, num_frames * h * w, -1, 2)
+
+    def build_all_rope(self, scale_specs, device):
+        """RoPE frequencies of the whole multi-scale sequence -> [B, S, D, 2].
+
+        `scale_specs` lists `(t_indices [B, F], h, w)` in sequence order (4x, 2x, 1x clean, then the
+        main latents); every scale is gathered from its grid and the pieces are joined with one cat.
+        Under no_grad the result is cached, since inference rebuilds the same layout every step.
+        """
+        if torch.is_grad_enabled():
+            return self._concat_rope(scale_specs, device)
+        key = (torch.device(device),) + tuple(
+            (h, w, tuple(t_indices.shape), tuple(t_indices.flatten().tolist())) for t_indices, h, w in scale_specs
+        )
+        rope_freqs = self._rope_cache.get(key)
+        if rope_freqs is None:
+            if len(self._rope_cache) >= self._rope_cache_size:
+                self._rope_cache.clear()
+            rope_freqs = self._concat_rope(scale_specs, device)
+            self._rope_cache[key] = rope_freqs
+        return rope_freqs
+
+    def _concat_rope(self, scale_specs, device):
+        pieces = [self.assemble_rope(t_indices, h, w, device) for t_indices, h, w in scale_specs]
+        return pieces[0] if len(pieces) == 1 else torch.cat(pieces, dim=1)
+
     def compute_router_decisions(self, combined_modality_input: torch.Tensor, modality_type: str):
         """
         不用router，直接根据modality_to_expert写死专家选择和权重
@@ -545,16 +888,53 @@ class WanModelMoe(torch.nn.Module):
         # 获取目标专家id
         target_expert_id = self.modality_to_expert.get(modality_type, 0)
 
+        # 专业化损失直接为0
+        specialization_loss = torch.tensor(0.0, device=combined_modality_input.device)
+
+        if top_k == 1:
+            # 🔧 确定性单专家路由：直接返回专家id，MoE只需运行该专家，不分配router张量
+            return None, target_expert_id, specialization_loss
+
         # router_indices: 全部填目标专家
         router_indices = torch.full((batch_size, seq_len, top_k), target_expert_id, dtype=torch.long, device=combined_modality_input.device)
         # router_weights: 全部为1
         router_weights = torch.ones((batch_size, seq_len, top_k), dtype=combined_modality_input.dtype, device=combined_modality_input.device)
 
-        # 专业化损失直接为0
-        specialization_loss = torch.tensor(0.0, device=combined_modality_input.device)
-
         return router_weights, router_indices, specialization_loss
 
+    def _apply(self, fn, *args, **kwargs):
+        self.clear_modulation_cache()
+        return super()._apply(fn, *args, **kwargs)
+
+    def train(self, mode: bool = True):
+        self.clear_modulation_cache()
+        return super().train(mode)
+
+    def clear_modulation_cache(self):
+        self._modulation_cache = None
+
+    def stacked_modulation(self, dtype, device):
+        """All blocks' modulation as one [num_layers, 1, 6, dim] tensor in the working dtype.
+
+        Training (or any grad-enabled call) stacks inside forward so gradients reach each block's
+        parameter; inference reuses the pre-cast stack until the weights are reloaded or moved.
+        """
+        params = tuple(block.modulation for block in self.blocks)
+        if self.training or torch.is_grad_enabled():
+            return torch.stack(params).to(dtype=dtype, device=device)
+        key = (dtype, torch.device(device))
+        cached = self._modulation_cache
+        if cached is None or cached[0] != key or any(a is not b for a, b in zip(cached[1], params)):
+            modulation = torch.stack(params).to(dtype=dtype, device=device)
+            self._modulation_cache = cached = (key, params, modulation)
+        return cached[2]
+
+    def precompute_modulation(self, t_mod: torch.Tensor):
+        """Per-block (shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp), with a single add for all blocks."""
+        modulation = self.stacked_modulation(t_mod.dtype, t_mod.device)
+        modulation = modulation + t_mod.unsqueeze(0)  # [num_layers, B, 6, dim]
+        return [m.chunk(6, dim=1) for m in modulation.unbind(0)]
+
     def patchify(self, x: torch.Tensor):
         x = self.patch_embedding(x)
         grid_size = x.shape[2:]
@@ -596,25 +976,22 @@ class WanModelMoe(torch.nn.Module):
         seq_len = frame_indices.shape[1]
         
         # 使用frame_indices生成时间维度的频率
-        f_freqs = self.freqs[0][frame_indices.to("cpu")]  # [batch, seq_len, freq_dim]
-        
-        # 为每个spatial位置生成频率
-        h_positions = torch.arange(height, device=device).unsqueeze(0).unsqueeze(0).expand(batch_size, seq_len, -1)
-        w_positions = torch.arange(width, device=device).unsqueeze(0).unsqueeze(0).expand(batch_size, seq_len, -1)
+        f_freqs, h_freqs, w_freqs = self.get_freqs(device)
+        f_freqs = f_freqs[frame_indices.to(device=device, dtype=torch.long)]  # [batch, seq_len, freq_dim, 2]
         
         # 获取h和w的频率
-        h_freqs = self.freqs[1][h_positions.to("cpu")]  # [batch, seq_len, height, h_freq_dim]
-        w_freqs = self.freqs[2][w_positions.to("cpu")]  # [batch, seq_len, width, w_freq_dim]
+        h_freqs = h_freqs[:height][None, None].expand(batch_size, seq_len, -1, -1, -1)  # [batch, seq_len, height, h_freq_dim, 2]
+        w_freqs = w_freqs[:width][None, None].expand(batch_size, seq_len, -1, -1, -1)  # [batch, seq_len, width, w_freq_dim, 2]
         
         # 扩展到完整的spatial grid
-        f_freqs_expanded = f_freqs.unsqueeze(2).unsqueeze(3).expand(-1, -1, height, width, -1)
-        h_freqs_expanded = h_freqs.unsqueeze(3).expand(-1, -1, -1, width, -1)
-        w_freqs_expanded = w_freqs.unsqueeze(2).expand(-1, -1, height, -1, -1)
+        f_freqs_expanded = f_freqs.unsqueeze(2).unsqueeze(3).expand(-1, -1, height, width, -1, -1)
+        h_freqs_expanded = h_freqs.unsqueeze(3).expand(-1, -1, -1, width, -1, -1)
+        w_freqs_expanded = w_freqs.unsqueeze(2).expand(-1, -1, height, -1, -1, -1)
         
         # 合并所有频率
-        rope_freqs = torch.cat([f_freqs_expanded, h_freqs_expanded, w_freqs_expanded], dim=-1)
+        rope_freqs = torch.cat([f_freqs_expanded, h_freqs_expanded, w_freqs_expanded], dim=-2)
         
-        return rope_freqs  # [batch, seq_len, height, width, total_freq_dim]
+        return rope_freqs  # [batch, seq_len, height, width, total_freq_dim, 2]
 
     def pad_for_3d_conv(self, x, kernel_size):
         """3D卷积的padding - 参考hunyuan实现"""
@@ -669,6 +1046,13 @@ class WanModelMoe(torch.nn.Module):
         
         return processed_modality_inputs, processed
     
+    @staticmethod
+    def build_scale_camera(cam_emb, valid_indices, num_frames, h, w, start_indice):
+        """🔧 按有效索引gather每帧camera并扩展到h*w空间 -> [B, num_frames*h*w, cam_dim]；越界或缺失的帧为0"""
+        if COMPILE_ELEMENTWISE_OPS and cam_emb.is_cuda:
+            return _scale_camera_fused(cam_emb, valid_indices, num_frames, h, w, start_indice)
+        return _scale_camera(cam_emb, valid_indices, num_frames, h, w, start_indice)
+
     def process_input_hidden_states(self, 
                                 latents, latent_indices=None,
                                 clean_latents=None, clean_latent_indices=None,
@@ -685,29 +1069,17 @@ class WanModelMoe(torch.nn.Module):
         
         # 🔧 修正：使用latent_indices指定的时间位置计算RoPE频率
         if latent_indices is None:
-            latent_indices = torch.arange(0, f, device=hidden_states.device).unsqueeze(0).expand(B, -1)
+            latent_indices = torch.arange(0, f).unsqueeze(0).expand(B, -1)
         
-        # 为主要latents计算RoPE频率
-        main_rope_freqs_list = []
-        for b in range(B):
-            batch_rope_freqs = []
-            for t_idx in latent_indices[b]:
-                f_freq = self.freqs[0][t_idx:t_idx+1]  # [1, freq_dim]
-                h_freq = self.freqs[1][:h]  # [h, freq_dim] 
-                w_freq = self.freqs[2][:w]  # [w, freq_dim]
-                
-                spatial_freqs = torch.cat([
-                    f_freq.view(1, 1, 1, -1).expand(1, h, w, -1),
-                    h_freq.view(1, h, 1, -1).expand(1, h, w, -1), 
-                    w_freq.view(1, 1, w, -1).expand(1, h, w, -1)
-                ], dim=-1).reshape(h * w, -1)  # [h*w, total_freq_dim]
-                
-                batch_rope_freqs.append(spatial_freqs)
-            
-            batch_rope_freqs = torch.cat(batch_rope_freqs, dim=0)  # [f*h*w, total_freq_dim]
-            main_rope_freqs_list.append(batch_rope_freqs)
+        # 🔧 FramePack索引统一放到CPU (通常本来就在CPU)，后面的.item()/min()/max()和mask过滤都不会触发GPU同步；
+        # 需要上device的地方 (assemble_rope / camera gather) 各自只做一次小的H2D拷贝
+        latent_indices, clean_latent_indices, clean_latent_2x_indices, clean_latent_4x_indices = (
+            None if indices is None else indices.to(device="cpu", dtype=torch.long)
+            for indices in (latent_indices, clean_latent_indices, clean_latent_2x_indices, clean_latent_4x_indices)
+        )
         
-        rope_freqs = torch.stack(main_rope_freqs_list, dim=0)  # [B, f*h*w, total_freq_dim]
+        # 为主要latents计算RoPE频率 - 各scale只记录(索引, h, w)，最后由build_all_rope一次性拼好
+        rope_specs = [(latent_indices, h, w)]
         
         # 🔧 准备主要scale (1x) 的modality embeddings - 空间维度为 h*w
         start_indice = clean_latent_indices[0][0].item() if clean_latent_indices is not None else 0
@@ -721,37 +1093,21 @@ class WanModelMoe(torch.nn.Module):
             target_camera = cam_emb[:, target_start:target_end, :]  # [B, target_frames, cam_dim]
             
             # 🔧 为主要latents处理camera空间扩展
-            target_camera_spatial = target_camera.unsqueeze(2).unsqueeze(3).repeat(1, 1, h, w, 1)
-            target_camera_spatial = rearrange(target_camera_spatial, 'b f h w d -> b (f h w) d')
+            # expand是view，reshape时只拷贝一次 (等价于 b f h w d -> b (f h w) d)
+            target_camera_spatial = target_camera[:, :, None, None, :].expand(-1, -1, h, w, -1)
+            target_camera_spatial = target_camera_spatial.reshape(B, -1, target_camera.shape[-1])
             combined_modality_embeddings = target_camera_spatial
         
+        # 🔧 各scale的clean部分依次prepend到前面；最后每个tensor只做一次cat (一次分配+拷贝)
+        hidden_states_chunks = [hidden_states]
+        modality_embedding_chunks = [combined_modality_embeddings]
+        
         # 🔧 处理clean_latents (1x scale) - 完全参考wan_video_dit_recam_future
         if clean_latents is not None and clean_latent_indices is not None:
-            clean_latents = clean_latents.to(hidden_states)
+            clean_latents = cast_like(clean_latents, hidden_states)
             clean_hidden_states = self.clean_x_embedder(clean_latents, scale="1x")
-            clean_hidden_states = rearrange(clean_hidden_states, 'b c f h w -> b (f h w) c')
-            
-            # 🔧 为clean_latents计算RoPE频率
-            clean_rope_freqs_list = []
-            for b in range(B):
-                clean_batch_rope_freqs = []
-                for t_idx in clean_latent_indices[b]:
-                    f_freq = self.freqs[0][t_idx:t_idx+1]
-                    h_freq = self.freqs[1][:h]
-                    w_freq = self.freqs[2][:w]
-                    
-                    spatial_freqs = torch.cat([
-                        f_freq.view(1, 1, 1, -1).expand(1, h, w, -1),
-                        h_freq.view(1, h, 1, -1).expand(1, h, w, -1),
-                        w_freq.view(1, 1, w, -1).expand(1, h, w, -1)
-                    ], dim=-1).reshape(h * w, -1)
-                    
-                    clean_batch_rope_freqs.append(spatial_freqs)
-                
-                clean_batch_rope_freqs = torch.cat(clean_batch_rope_freqs, dim=0)
-                clean_rope_freqs_list.append(clean_batch_rope_freqs)
+            clean_hidden_states = clean_hidden_states.flatten(2).transpose(1, 2)  # b c f h w -> b (f h w) c, view only
             
-            clean_rope_freqs = torch.stack(clean_rope_freqs_list, dim=0)
             
             # 🔧 处理clean modality embeddings - 1x空间维度
             if cam_emb is not None:
@@ -764,13 +1120,13 @@ class WanModelMoe(torch.nn.Module):
                     clean_camera = cam_emb[:, [clean_start, clean_end], :]   # [B, 2, cam_dim]  
                                 
                 # 扩展到1x空间维度 h*w
-                clean_camera_spatial = clean_camera.unsqueeze(2).unsqueeze(3).repeat(1, 1, h, w, 1)
-                clean_camera_spatial = rearrange(clean_camera_spatial, 'b f h w d -> b (f h w) d')
-                combined_modality_embeddings = torch.cat([clean_camera_spatial, combined_modality_embeddings], dim=1)
+                clean_camera_spatial = clean_camera[:, :, None, None, :].expand(-1, -1, h, w, -1)
+                clean_camera_spatial = clean_camera_spatial.reshape(B, -1, clean_camera.shape[-1])
+                modality_embedding_chunks.insert(0, clean_camera_spatial)
             
-            # cat clean latents和frequencies到前面
-            hidden_states = torch.cat([clean_hidden_states, hidden_states], dim=1)
-            rope_freqs = torch.cat([clean_rope_freqs, rope_freqs], dim=1)
+            # clean latents和frequencies放到前面
+            hidden_states_chunks.insert(0, clean_hidden_states)
+            rope_specs.insert(0, (clean_latent_indices, h, w))
         
         # 🔧 处理clean_latents_2x (2x scale) - 完全参考wan_video_dit_recam_future
         if clean_latents_2x is not None and clean_latent_2x_indices is not None and clean_latent_2x_indices.numel() > 0:
@@ -778,60 +1134,25 @@ class WanModelMoe(torch.nn.Module):
             valid_2x_indices = clean_latent_2x_indices[clean_latent_2x_indices >= 0]
             
             if len(valid_2x_indices) > 0:
-                clean_latents_2x = clean_latents_2x.to(hidden_states)
+                clean_latents_2x = cast_like(clean_latents_2x, hidden_states)
                 clean_latents_2x = self.pad_for_3d_conv(clean_latents_2x, (2, 4, 4))
                 clean_hidden_states_2x = self.clean_x_embedder(clean_latents_2x, scale="2x")
                 
                 _, _, clean_2x_f, clean_2x_h, clean_2x_w = clean_hidden_states_2x.shape
-                clean_hidden_states_2x = rearrange(clean_hidden_states_2x, 'b c f h w -> b (f h w) c')
+                clean_hidden_states_2x = clean_hidden_states_2x.flatten(2).transpose(1, 2)  # b c f h w -> b (f h w) c, view only
                 
                 # 🔧 为2x latents计算RoPE频率 - 基于实际的下采样结果
-                clean_2x_rope_freqs_list = []
-                for b in range(B):
-                    clean_2x_batch_rope_freqs = []
-                    
-                    # 🔧 使用clean_2x_f作为实际的时间帧数
-                    for frame_idx in range(clean_2x_f):
-                        # 计算对应的原始时间索引
-                        if frame_idx < len(valid_2x_indices):
-                            t_idx = valid_2x_indices[frame_idx]
-                        else:
-                            # 如果超出有效索引，使用0频率
-                            t_idx = valid_2x_indices[-1] if len(valid_2x_indices) > 0 else 0
-                        
-                        f_freq = self.freqs[0][t_idx:t_idx+1]
-                        h_freq = self.freqs[1][:clean_2x_h]
-                        w_freq = self.freqs[2][:clean_2x_w]
-                        
-                        spatial_freqs = torch.cat([
-                            f_freq.view(1, 1, 1, -1).expand(1, clean_2x_h, clean_2x_w, -1),
-                            h_freq.view(1, clean_2x_h, 1, -1).expand(1, clean_2x_h, clean_2x_w, -1),
-                            w_freq.view(1, 1, clean_2x_w, -1).expand(1, clean_2x_h, clean_2x_w, -1)
-                        ], dim=-1).reshape(clean_2x_h * clean_2x_w, -1)
-                        
-                        clean_2x_batch_rope_freqs.append(spatial_freqs)
-                    
-                    clean_2x_batch_rope_freqs = torch.cat(clean_2x_batch_rope_freqs, dim=0)
-                    clean_2x_rope_freqs_list.append(clean_2x_batch_rope_freqs)
-                
-                clean_2x_rope_freqs = torch.stack(clean_2x_rope_freqs_list, dim=0)
+                clean_2x_t_indices = self.scale_rope_indices(valid_2x_indices, clean_2x_f, B)
                 
                 # 🔧 处理2x modality embeddings
                 if cam_emb is not None:
                     # 创建2x camera，0填充无效部分
-                    clean_2x_camera = torch.zeros(B, clean_2x_f, cam_emb.shape[-1], dtype=cam_emb.dtype, device=cam_emb.device)
-                    
-                    for frame_idx in range(min(clean_2x_f, len(valid_2x_indices))):
-                        cam_idx = valid_2x_indices[frame_idx].item() - start_indice
-                        if 0 <= cam_idx < cam_emb.shape[1]:
-                            clean_2x_camera[:, frame_idx, :] = cam_emb[:, cam_idx, :]
-                    
-                    clean_2x_camera_spatial = clean_2x_camera.unsqueeze(2).unsqueeze(3).repeat(1, 1, clean_2x_h, clean_2x_w, 1)
-                    clean_2x_camera_spatial = rearrange(clean_2x_camera_spatial, 'b f h w d -> b (f h w) d')
-                    combined_modality_embeddings = torch.cat([clean_2x_camera_spatial, combined_modality_embeddings], dim=1)
+                    clean_2x_camera_spatial = self.build_scale_camera(
+                        cam_emb, valid_2x_indices, clean_2x_f, clean_2x_h, clean_2x_w, start_indice)
+                    modality_embedding_chunks.insert(0, clean_2x_camera_spatial)
                 
-                hidden_states = torch.cat([clean_hidden_states_2x, hidden_states], dim=1)
-                rope_freqs = torch.cat([clean_2x_rope_freqs, rope_freqs], dim=1)
+                hidden_states_chunks.insert(0, clean_hidden_states_2x)
+                rope_specs.insert(0, (clean_2x_t_indices, clean_2x_h, clean_2x_w))
         
         # 🔧 处理clean_latents_4x (4x scale) - 完全参考wan_video_dit_recam_future
         if clean_latents_4x is not None and clean_latent_4x_indices is not None and clean_latent_4x_indices.numel() > 0:
@@ -839,62 +1160,32 @@ class WanModelMoe(torch.nn.Module):
             valid_4x_indices = clean_latent_4x_indices[clean_latent_4x_indices >= 0]
             
             if len(valid_4x_indices) > 0:
-                clean_latents_4x = clean_latents_4x.to(hidden_states)
+                clean_latents_4x = cast_like(clean_latents_4x, hidden_states)
                 clean_latents_4x = self.pad_for_3d_conv(clean_latents_4x, (4, 8, 8))
                 clean_hidden_states_4x = self.clean_x_embedder(clean_latents_4x, scale="4x")
                 
                 _, _, clean_4x_f, clean_4x_h, clean_4x_w = clean_hidden_states_4x.shape
-                clean_hidden_states_4x = rearrange(clean_hidden_states_4x, 'b c f h w -> b (f h w) c')
+                clean_hidden_states_4x = clean_hidden_states_4x.flatten(2).transpose(1, 2)  # b c f h w -> b (f h w) c, view only
                 
                 # 🔧 为4x latents计算RoPE频率 - 基于实际的下采样结果
-                clean_4x_rope_freqs_list = []
-                for b in range(B):
-                    clean_4x_batch_rope_freqs = []
-                    
-                    # 🔧 使用clean_4x_f作为实际的时间帧数
-                    for frame_idx in range(clean_4x_f):
-                        # 计算对应的原始时间索引
-                        if frame_idx < len(valid_4x_indices):
-                            t_idx = valid_4x_indices[frame_idx]
-                        else:
-                            # 如果超出有效索引，使用0频率
-                            t_idx = valid_4x_indices[-1] if len(valid_4x_indices) > 0 else 0
-                        
-                        f_freq = self.freqs[0][t_idx:t_idx+1]
-                        h_freq = self.freqs[1][:clean_4x_h]
-                        w_freq = self.freqs[2][:clean_4x_w]
-                        
-                        spatial_freqs = torch.cat([
-                            f_freq.view(1, 1, 1, -1).expand(1, clean_4x_h, clean_4x_w, -1),
-                            h_freq.view(1, clean_4x_h, 1, -1).expand(1, clean_4x_h, clean_4x_w, -1),
-                            w_freq.view(1, 1, clean_4x_w, -1).expand(1, clean_4x_h, clean_4x_w, -1)
-                        ], dim=-1).reshape(clean_4x_h * clean_4x_w, -1)
-                        
-                        clean_4x_batch_rope_freqs.append(spatial_freqs)
-                    
-                    clean_4x_batch_rope_freqs = torch.cat(clean_4x_batch_rope_freqs, dim=0)
-                    clean_4x_rope_freqs_list.append(clean_4x_batch_rope_freqs)
-                
-                clean_4x_rope_freqs = torch.stack(clean_4x_rope_freqs_list, dim=0)
+                clean_4x_t_indices = self.scale_rope_indices(valid_4x_indices, clean_4x_f, B)
                 
                 # 🔧 处理4x modality embeddings
                 if cam_emb is not None:
                     # 创建4x camera，0填充无效部分
-                    clean_4x_camera = torch.zeros(B, clean_4x_f, cam_emb.shape[-1], dtype=cam_emb.dtype, device=cam_emb.device)
-                    
-                    for frame_idx in range(min(clean_4x_f, len(valid_4x_indices))):
-                        cam_idx = valid_4x_indices[frame_idx].item() - start_indice
-                        if 0 <= cam_idx < cam_emb.shape[1]:
-                            clean_4x_camera[:, frame_idx, :] = cam_emb[:, cam_idx, :]
-                    
-                    clean_4x_camera_spatial = clean_4x_camera.unsqueeze(2).unsqueeze(3).repeat(1, 1, clean_4x_h, clean_4x_w, 1)
-                    clean_4x_camera_spatial = rearrange(clean_4x_camera_spatial, 'b f h w d -> b (f h w) d')
-                    combined_modality_embeddings = torch.cat([clean_4x_camera_spatial, combined_modality_embeddings], dim=1)
+                    clean_4x_camera_spatial = self.build_scale_camera(
+                        cam_emb, valid_4x_indices, clean_4x_f, clean_4x_h, clean_4x_w, start_indice)
+                    modality_embedding_chunks.insert(0, clean_4x_camera_spatial)
                 
-                hidden_states = torch.cat([clean_hidden_states_4x, hidden_states], dim=1)
-                rope_freqs = torch.cat([clean_4x_rope_freqs, rope_freqs], dim=1)
+                hidden_states_chunks.insert(0, clean_hidden_states_4x)
+                rope_specs.insert(0, (clean_4x_t_indices, clean_4x_h, clean_4x_w))
+        
+        if len(hidden_states_chunks) > 1:
+            hidden_states = torch.cat(hidden_states_chunks, dim=1)
+            if cam_emb is not None:
+                combined_modality_embeddings = torch.cat(modality_embedding_chunks, dim=1)
         
-        rope_freqs = rope_freqs.unsqueeze(2).to(device=hidden_states.device)
+        rope_freqs = self.build_all_rope(rope_specs, hidden_states.device).unsqueeze(2)  # [B, S, 1, D, 2]
         
         # 🔧 关键修正：在return前处理modality_inputs
         processed_modality_inputs = None
@@ -920,9 +1211,9 @@ class WanModelMoe(torch.nn.Module):
         
         modality_inputs, cam_emb = self.process_modality_inputs(modality_inputs)
         
-        # 🔧 清空之前的专家统计信息
-        for block in self.blocks:
-            if hasattr(block, 'expert_stats_buffer'):
+        # 🔧 清空之前的专家统计信息 (只在收集统计时; buffer只保留本次forward的结果)
+        if self.collect_expert_stats or self.training:
+            for block in self.blocks:
                 block.expert_stats_buffer = []
         
         # 🔧 使用新的处理方法来处理多尺度输入和RoPE频率 + MoE模态输入
@@ -950,9 +1241,10 @@ class WanModelMoe(torch.nn.Module):
             sinusoidal_embedding_1d(self.freq_dim, timestep))
         t_mod = self.time_projection(t).unflatten(1, (6, self.dim))
 
-        # 确保rope_freqs与hidden_states的序列长度匹配
-        assert rope_freqs.shape[1] == hidden_states.shape[1], \
-            f"RoPE频率序列长度 {rope_freqs.shape[1]} 与 hidden_states序列长度 {hidden_states.shape[1]} 不匹配"
+        # 确保rope_freqs与hidden_states的序列长度匹配 (调试检查，默认关闭)
+        if self._debug:
+            assert rope_freqs.shape[1] == hidden_states.shape[1], \
+                f"RoPE频率序列长度 {rope_freqs.shape[1]} 与 hidden_states序列长度 {hidden_states.shape[1]} 不匹配"
         
         # 🔧 全局router决策计算（一次性为所有层计算）
         router_weights, router_indices, total_specialization_loss = None, None, torch.tensor(0.0, device=hidden_states.device)
@@ -960,13 +1252,7 @@ class WanModelMoe(torch.nn.Module):
         
         if self.use_moe and processed_modality_inputs:
             # 合并所有模态的输入
-            combined_modality_input = None
-            for modality_type, processed_input in processed_modality_inputs.items():
-                active_modality = modality_type
-                if combined_modality_input is None:
-                    combined_modality_input = processed_input
-                else:
-                    combined_modality_input = combined_modality_input + processed_input
+            combined_modality_input, active_modality = combine_modality_inputs(processed_modality_inputs)
             
             #router_input = torch.cat([hidden_states, combined_modality_input], dim=-1)
             if combined_modality_input is not None:
@@ -975,7 +1261,8 @@ class WanModelMoe(torch.nn.Module):
                 )
         
         # 🔧 Transformer blocks - 传递全局router的结果
-        for block in self.blocks:
+        block_modulations = self.precompute_modulation(t_mod)
+        for block, modulation in zip(self.blocks, block_modulations):
             hidden_states = block(
                 hidden_states, 
                 context, 
@@ -984,7 +1271,8 @@ class WanModelMoe(torch.nn.Module):
                 rope_freqs, 
                 processed_modality_inputs,
                 router_weights,  # 🔧 传递全局router权重
-                router_indices   # 🔧 传递全局router索引
+                router_indices,  # 🔧 传递全局router索引
+                modulation
             )
         
         # 🔧 收集并打印整体专家统计信息
@@ -1039,10 +1327,11 @@ class WanModelMoe(torch.nn.Module):
                 continue
                 
             # 计算该模态的平均统计
-            avg_selection_ratio = np.mean(stats['selection_ratios'], axis=0)
-            avg_expert_weights = np.mean(stats['expert_weights'], axis=0)
-            avg_top_k_weights = np.mean(stats['top_k_weights'], axis=0)
-            avg_target_expert_usage = np.mean(stats['target_expert_usages'])
+            # 在device上stack求均值，每个统计量只拷回host一次
+            avg_selection_ratio = mean_of_stats(stats['selection_ratios']).tolist()
+            avg_expert_weights = mean_of_stats(stats['expert_weights']).tolist()
+            avg_top_k_weights = mean_of_stats(stats['top_k_weights']).tolist()
+            avg_target_expert_usage = mean_of_stats(stats['target_expert_usages']).item()
             target_expert_id = stats['target_expert_id']
             
             print(f"\n {modality.upper()} modality (Source {stats['count']} MoE blocks)")
@@ -1070,7 +1359,7 @@ class WanModelMoe(torch.nn.Module):
             print(f"   专业化程度: {specialization_status}")
             
             # 找出最常用的专家
-            most_used_expert = np.argmax(avg_selection_ratio)
+            most_used_expert = max(range(len(avg_selection_ratio)), key=avg_selection_ratio.__getitem__)
             most_used_ratio = avg_selection_ratio[most_used_expert]
             if most_used_expert == target_expert_id:
                 print(f"   Actual most expert: Expert-{most_used_expert} ({most_used_ratio:.3f}) - OK!")
@@ -1084,65 +1373,70 @@ class WanModelMoe(torch.nn.Module):
         return WanModelStateDictConverter()
     
     
+# diffusers -> DiffSynth key renames. Per-block entries are stored without the `blocks.{i}.` prefix,
+# so a block key is renamed with one split and one dict lookup regardless of the number of layers.
+DIFFUSERS_BLOCK_RENAME_DICT = {
+    "attn1.norm_k.weight": "self_attn.norm_k.weight",
+    "attn1.norm_q.weight": "self_attn.norm_q.weight",
+    "attn1.to_k.bias": "self_attn.k.bias",
+    "attn1.to_k.weight": "self_attn.k.weight",
+    "attn1.to_out.0.bias": "self_attn.o.bias",
+    "attn1.to_out.0.weight": "self_attn.o.weight",
+    "attn1.to_q.bias": "self_attn.q.bias",
+    "attn1.to_q.weight": "self_attn.q.weight",
+    "attn1.to_v.bias": "self_attn.v.bias",
+    "attn1.to_v.weight": "self_attn.v.weight",
+    "attn2.norm_k.weight": "cross_attn.norm_k.weight",
+    "attn2.norm_q.weight": "cross_attn.norm_q.weight",
+    "attn2.to_k.bias": "cross_attn.k.bias",
+    "attn2.to_k.weight": "cross_attn.k.weight",
+    "attn2.to_out.0.bias": "cross_attn.o.bias",
+    "attn2.to_out.0.weight": "cross_attn.o.weight",
+    "attn2.to_q.bias": "cross_attn.q.bias",
+    "attn2.to_q.weight": "cross_attn.q.weight",
+    "attn2.to_v.bias": "cross_attn.v.bias",
+    "attn2.to_v.weight": "cross_attn.v.weight",
+    "ffn.net.0.proj.bias": "ffn.0.bias",
+    "ffn.net.0.proj.weight": "ffn.0.weight",
+    "ffn.net.2.bias": "ffn.2.bias",
+    "ffn.net.2.weight": "ffn.2.weight",
+    "norm2.bias": "norm3.bias",
+    "norm2.weight": "norm3.weight",
+    "scale_shift_table": "modulation",
+}
+
+DIFFUSERS_RENAME_DICT = {
+    "condition_embedder.text_embedder.linear_1.bias": "text_embedding.0.bias",
+    "condition_embedder.text_embedder.linear_1.weight": "text_embedding.0.weight",
+    "condition_embedder.text_embedder.linear_2.bias": "text_embedding.2.bias",
+    "condition_embedder.text_embedder.linear_2.weight": "text_embedding.2.weight",
+    "condition_embedder.time_embedder.linear_1.bias": "time_embedding.0.bias",
+    "condition_embedder.time_embedder.linear_1.weight": "time_embedding.0.weight",
+    "condition_embedder.time_embedder.linear_2.bias": "time_embedding.2.bias",
+    "condition_embedder.time_embedder.linear_2.weight": "time_embedding.2.weight",
+    "condition_embedder.time_proj.bias": "time_projection.1.bias",
+    "condition_embedder.time_proj.weight": "time_projection.1.weight",
+    "patch_embedding.bias": "patch_embedding.bias",
+    "patch_embedding.weight": "patch_embedding.weight",
+    "scale_shift_table": "head.modulation",
+    "proj_out.bias": "head.head.bias",
+    "proj_out.weight": "head.head.weight",
+}
+
+
 class WanModelStateDictConverter:
     def __init__(self):
         pass
 
     def from_diffusers(self, state_dict):
-        rename_dict = {
-            "blocks.0.attn1.norm_k.weight": "blocks.0.self_attn.norm_k.weight",
-            "blocks.0.attn1.norm_q.weight": "blocks.0.self_attn.norm_q.weight",
-            "blocks.0.attn1.to_k.bias": "blocks.0.self_attn.k.bias",
-            "blocks.0.attn1.to_k.weight": "blocks.0.self_attn.k.weight",
-            "blocks.0.attn1.to_out.0.bias": "blocks.0.self_attn.o.bias",
-            "blocks.0.attn1.to_out.0.weight": "blocks.0.self_attn.o.weight",
-            "blocks.0.attn1.to_q.bias": "blocks.0.self_attn.q.bias",
-            "blocks.0.attn1.to_q.weight": "blocks.0.self_attn.q.weight",
-            "blocks.0.attn1.to_v.bias": "blocks.0.self_attn.v.bias",
-            "blocks.0.attn1.to_v.weight": "blocks.0.self_attn.v.weight",
-            "blocks.0.attn2.norm_k.weight": "blocks.0.cross_attn.norm_k.weight",
-            "blocks.0.attn2.norm_q.weight": "blocks.0.cross_attn.norm_q.weight",
-            "blocks.0.attn2.to_k.bias": "blocks.0.cross_attn.k.bias",
-            "blocks.0.attn2.to_k.weight": "blocks.0.cross_attn.k.weight",
-            "blocks.0.attn2.to_out.0.bias": "blocks.0.cross_attn.o.bias",
-            "blocks.0.attn2.to_out.0.weight": "blocks.0.cross_attn.o.weight",
-            "blocks.0.attn2.to_q.bias": "blocks.0.cross_attn.q.bias",
-            "blocks.0.attn2.to_q.weight": "blocks.0.cross_attn.q.weight",
-            "blocks.0.attn2.to_v.bias": "blocks.0.cross_attn.v.bias",
-            "blocks.0.attn2.to_v.weight": "blocks.0.cross_attn.v.weight",
-            "blocks.0.ffn.net.0.proj.bias": "blocks.0.ffn.0.bias",
-            "blocks.0.ffn.net.0.proj.weight": "blocks.0.ffn.0.weight",
-            "blocks.0.ffn.net.2.bias": "blocks.0.ffn.2.bias",
-            "blocks.0.ffn.net.2.weight": "blocks.0.ffn.2.weight",
-            "blocks.0.norm2.bias": "blocks.0.norm3.bias",
-            "blocks.0.norm2.weight": "blocks.0.norm3.weight",
-            "blocks.0.scale_shift_table": "blocks.0.modulation",
-            "condition_embedder.text_embedder.linear_1.bias": "text_embedding.0.bias",
-            "condition_embedder.text_embedder.linear_1.weight": "text_embedding.0.weight",
-            "condition_embedder.text_embedder.linear_2.bias": "text_embedding.2.bias",
-            "condition_embedder.text_embedder.linear_2.weight": "text_embedding.2.weight",
-            "condition_embedder.time_embedder.linear_1.bias": "time_embedding.0.bias",
-            "condition_embedder.time_embedder.linear_1.weight": "time_embedding.0.weight",
-            "condition_embedder.time_embedder.linear_2.bias": "time_embedding.2.bias",
-            "condition_embedder.time_embedder.linear_2.weight": "time_embedding.2.weight",
-            "condition_embedder.time_proj.bias": "time_projection.1.bias",
-            "condition_embedder.time_proj.weight": "time_projection.1.weight",
-            "patch_embedding.bias": "patch_embedding.bias",
-            "patch_embedding.weight": "patch_embedding.weight",
-            "scale_shift_table": "head.modulation",
-            "proj_out.bias": "head.head.bias",
-            "proj_out.weight": "head.head.weight",
-        }
         state_dict_ = {}
         for name, param in state_dict.items():
-            if name in rename_dict:
-                state_dict_[rename_dict[name]] = param
-            else:
-                name_ = ".".join(name.split(".")[:1] + ["0"] + name.split(".")[2:])
-                if name_ in rename_dict:
-                    name_ = rename_dict[name_]
-                    name_ = ".".join(name_.split(".")[:1] + [name.split(".")[1]] + name_.split(".")[2:])
-                    state_dict_[name_] = param
+            if name in DIFFUSERS_RENAME_DICT:
+                state_dict_[DIFFUSERS_RENAME_DICT[name]] = param
+            elif name.startswith("blocks.") and name.count(".") >= 2:
+                _, block_id, block_name = name.split(".", 2)
+                if block_name in DIFFUSERS_BLOCK_RENAME_DICT:
+                    state_dict_[f"blocks.{block_id}.{DIFFUSERS_BLOCK_RENAME_DICT[block_name]}"] = param
         if hash_state_dict_keys(state_dict) == "cb104773c6c2cb6df4f9529ad5c60d0b":
             config = {
                 "model_type": "t2v",
@@ -1166,7 +1460,8 @@ class WanModelStateDictConverter:
         return state_dict_, config
     
     def from_civitai(self, state_dict):
-        if hash_state_dict_keys(state_dict) == "9269f8db9040a9d860eaca435be61814":
+        state_dict_hash = hash_state_dict_keys(state_dict)
+        if state_dict_hash == "9269f8db9040a9d860eaca435be61814":
             config = {
                 "has_image_input": False,
                 "patch_size": [1, 2, 2],
@@ -1180,7 +1475,7 @@ class WanModelStateDictConverter:
                 "num_layers": 30,
                 "eps": 1e-6
             }
-        elif hash_state_dict_keys(state_dict) == "aafcfd9672c3a2456dc46e1cb6e52c70":
+        elif state_dict_hash == "aafcfd9672c3a2456dc46e1cb6e52c70":
             config = {
                 "has_image_input": False,
                 "patch_size": [1, 2, 2],
@@ -1194,7 +1489,7 @@ class WanModelStateDictConverter:
                 "num_layers": 40,
                 "eps": 1e-6
             }
-        elif hash_state_dict_keys(state_dict) == "6bfcfb3b342cb286ce886889d519a77e":
+        elif state_dict_hash == "6bfcfb3b342cb286ce886889d519a77e":
             config = {
                 "has_image_input": True,
                 "patch_size": [1, 2, 2],
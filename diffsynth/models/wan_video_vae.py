@@ -693,7 +693,7 @@ class WanVideoVAE(nn.Module):
 
 
     def tiled_encode(self, video, device, tile_size, tile_stride):
-        _, _, T, H, W = video.shape
+        B, _, T, H, W = video.shape
         size_h, size_w = tile_size
         stride_h, stride_w = tile_stride
 
@@ -711,7 +711,7 @@ class WanVideoVAE(nn.Module):
 
         out_T = (T + 3) // 4
         weight = torch.zeros((1, 1, out_T, H // self.upsampling_factor, W // self.upsampling_factor), dtype=video.dtype, device=data_device)
-        values = torch.zeros((1, 16, out_T, H // self.upsampling_factor, W // self.upsampling_factor), dtype=video.dtype, device=data_device)
+        values = torch.zeros((B, 16, out_T, H // self.upsampling_factor, W // self.upsampling_factor), dtype=video.dtype, device=data_device)
 
         for h, h_, w, w_ in tqdm(tasks, desc="VAE encoding"):
             hidden_states_batch = video[:, :, :, h:h_, w:w_].to(computation_device)
@@ -756,20 +756,16 @@ class WanVideoVAE(nn.Module):
 
 
     def encode(self, videos, device, tiled=False, tile_size=(34, 34), tile_stride=(18, 16)):
-
-        videos = [video.to("cpu") for video in videos]
-        hidden_states = []
-        for video in videos:
-            video = video.unsqueeze(0)
-            if tiled:
-                tile_size = (tile_size[0] * 8, tile_size[1] * 8)
-                tile_stride = (tile_stride[0] * 8, tile_stride[1] * 8)
-                hidden_state = self.tiled_encode(video, device, tile_size, tile_stride)
-            else:
-                hidden_state = self.single_encode(video, device)
-            hidden_state = hidden_state.squeeze(0)
-            hidden_states.append(hidden_state)
-        hidden_states = torch.stack(hidden_states)
+        # 🔧 同尺寸的一批 clip 一次送进 VAE（conv/attention/feat_cache 都沿 batch 维计算），
+        # 不再逐个 clip 搬回 CPU 再编码，输入的内存布局（如 channels_last_3d）也得以保留
+        if isinstance(videos, (list, tuple)):
+            videos = torch.stack(list(videos))
+        if tiled:
+            tile_size = (tile_size[0] * 8, tile_size[1] * 8)
+            tile_stride = (tile_stride[0] * 8, tile_stride[1] * 8)
+            hidden_states = self.tiled_encode(videos, device, tile_size, tile_stride)
+        else:
+            hidden_states = self.single_encode(videos, device)
         return hidden_states
 
 
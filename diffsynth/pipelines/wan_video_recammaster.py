@@ -423,8 +423,13 @@ def model_fn_wan_video(
         x = tea_cache.update(x)
     else:
         # blocks
-        for block in dit.blocks:
-            x = block(x, context, cam_emb, t_mod, freqs)
+        # WanModel.encode_cameras 批量编码 cam_emb；其余 DiT 在 block 内编码原始位姿
+        if cam_emb is not None and hasattr(dit, "encode_cameras"):
+            for block, block_cam_emb in zip(dit.blocks, dit.encode_cameras(cam_emb)):
+                x = block(x, context, block_cam_emb, t_mod, freqs, cam_emb_encoded=True)
+        else:
+            for block in dit.blocks:
+                x = block(x, context, cam_emb, t_mod, freqs)
         if tea_cache is not None:
             tea_cache.store(x)
 
@@ -133,7 +133,7 @@ def replace_dit_model_in_manager():
 def add_framepack_components(dit_model):
     """添加FramePack相关组件"""
     if not hasattr(dit_model, 'clean_x_embedder'):
-        inner_dim = dit_model.blocks[0].self_attn.q.weight.shape[0]
+        inner_dim = dit_model.blocks[0].self_attn.dim
         
         class CleanXEmbedder(nn.Module):
             def __init__(self, inner_dim):
@@ -169,7 +169,7 @@ def add_moe_components(dit_model, moe_config):
     dit_model.top_k = moe_config.get("top_k", 1)
 
     # 为每个block动态添加MoE组件
-    dim = dit_model.blocks[0].self_attn.q.weight.shape[0]
+    dim = dit_model.blocks[0].self_attn.dim
     unified_dim = moe_config.get("unified_dim", 25)
     num_experts = moe_config.get("num_experts", 4)
     from diffsynth.models.wan_video_dit_moe import ModalityProcessor, MultiModalMoE
@@ -586,7 +586,9 @@ def inference_moe_framepack_sliding_window(
     # MoE参数
     moe_num_experts=4,
     moe_top_k=2,
-    moe_hidden_dim=None
+    moe_hidden_dim=None,
+    compile_blocks=False,
+    compile_dynamic=False
 ):
     """
     MoE FramePack滑动窗口视频生成 - 支持多模态
@@ -610,7 +612,7 @@ def inference_moe_framepack_sliding_window(
     pipe = WanVideoReCamMasterPipeline.from_model_manager(model_manager, device="cuda")
 
     # 2. 添加传统camera编码器（兼容性）
-    dim = pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+    dim = pipe.dit.blocks[0].self_attn.dim
     for block in pipe.dit.blocks:
         block.cam_encoder = nn.Linear(13, dim)
         block.projector = nn.Linear(dim, dim)
@@ -643,6 +645,10 @@ def inference_moe_framepack_sliding_window(
         pipe.dit.clean_x_embedder = pipe.dit.clean_x_embedder.to(dtype=model_dtype)
     
     pipe.scheduler.set_timesteps(50)
+
+    if compile_blocks:
+        # 🔧 权重加载并移到设备之后再编译DiT block
+        pipe.dit.enable_block_compile(dynamic=compile_dynamic)
     
     # 6. 加载初始条件
     print("Loading initial condition frames...")
@@ -978,6 +984,8 @@ def main():
     parser.add_argument("--moe_num_experts", type=int, default=3, help="专家数量")
     parser.add_argument("--moe_top_k", type=int, default=1, help="Top-K专家")
     parser.add_argument("--moe_hidden_dim", type=int, default=None, help="MoE隐藏层维度")
+    parser.add_argument("--compile_blocks", action="store_true", help="torch.compile每个DiT block (mode=reduce-overhead)")
+    parser.add_argument("--compile_dynamic", action="store_true", help="按动态shape编译block；history帧数随滑动窗口增长时避免反复重编译")
     
     args = parser.parse_args()
 
@@ -1015,7 +1023,9 @@ def main():
         # MoE参数
         moe_num_experts=args.moe_num_experts,
         moe_top_k=args.moe_top_k,
-        moe_hidden_dim=args.moe_hidden_dim
+        moe_hidden_dim=args.moe_hidden_dim,
+        compile_blocks=args.compile_blocks,
+        compile_dynamic=args.compile_dynamic
     )
 
 
@@ -83,7 +83,7 @@ def replace_dit_model_in_manager():
 def add_framepack_components(dit_model):
     """添加FramePack相关组件"""
     if not hasattr(dit_model, 'clean_x_embedder'):
-        inner_dim = dit_model.blocks[0].self_attn.q.weight.shape[0]
+        inner_dim = dit_model.blocks[0].self_attn.dim
         
         class CleanXEmbedder(nn.Module):
             def __init__(self, inner_dim):
@@ -118,7 +118,7 @@ def add_moe_components(dit_model, moe_config):
         print("✅ 添加了MoE配置到模型")
     
     # 为每个block动态添加MoE组件
-    dim = dit_model.blocks[0].self_attn.q.weight.shape[0]
+    dim = dit_model.blocks[0].self_attn.dim
     unified_dim = moe_config.get("unified_dim", 25)
     
     for i, block in enumerate(dit_model.blocks):
@@ -564,7 +564,7 @@ def inference_moe_framepack_sliding_window(
     pipe = WanVideoReCamMasterPipeline.from_model_manager(model_manager, device="cuda")
 
     # 2. 添加传统camera编码器（兼容性）
-    dim = pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+    dim = pipe.dit.blocks[0].self_attn.dim
     for block in pipe.dit.blocks:
         block.cam_encoder = nn.Linear(13, dim)
         block.projector = nn.Linear(dim, dim)
@@ -396,7 +396,7 @@ class SpatialVidFramePackLightningModel(pl.LightningModule):
         self.add_moe_components()
 
         # 添加相机编码器
-        dim = self.pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+        dim = self.pipe.dit.blocks[0].self_attn.dim
         for block in self.pipe.dit.blocks:
             block.cam_encoder = nn.Linear(13, dim)
             block.projector = nn.Linear(dim, dim)
@@ -429,7 +429,7 @@ class SpatialVidFramePackLightningModel(pl.LightningModule):
     def add_framepack_components(self):
         """🔧 添加FramePack相关组件"""
         if not hasattr(self.pipe.dit, 'clean_x_embedder'):
-            inner_dim = self.pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+            inner_dim = self.pipe.dit.blocks[0].self_attn.dim
             
             class CleanXEmbedder(nn.Module):
                 def __init__(self, inner_dim):
@@ -459,7 +459,7 @@ class SpatialVidFramePackLightningModel(pl.LightningModule):
             print("✅ 添加了MoE配置到模型")
         
         # 为每个block动态添加MoE组件
-        dim = self.pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+        dim = self.pipe.dit.blocks[0].self_attn.dim
         unified_dim = 25
         
         for i, block in enumerate(self.pipe.dit.blocks):
@@ -603,7 +603,9 @@ class SpatialVidFramePackLightningModel(pl.LightningModule):
         current_step = self.global_step
         checkpoint.clear()
         
-        state_dict = self.pipe.denoising_model().state_dict()
+        # 🔧 MoE DiT 内部把 q/k/v、k/v 融合成一个 Linear；保存时拆回原始 key，checkpoint 和非 MoE 的 DiT / 外部工具保持兼容
+        from diffsynth.models.wan_video_dit_moe import unfuse_linear_state_dict
+        state_dict = unfuse_linear_state_dict(self.pipe.denoising_model().state_dict())
         torch.save(state_dict, os.path.join(checkpoint_dir, f"step{current_step}.ckpt"))
         print(f"Saved SpatialVid FramePack model checkpoint: step{current_step}.ckpt")
 
@@ -659,7 +659,9 @@ class MultiDatasetLightningModelForTrain(pl.LightningModule):
         resume_ckpt_path=None,
         # 🔧 MoE参数
         use_moe=False,
-        moe_config=None
+        moe_config=None,
+        compile_blocks=False,
+        compile_dynamic=False
     ):
         super().__init__()
         self.use_moe = use_moe
@@ -683,7 +685,7 @@ class MultiDatasetLightningModelForTrain(pl.LightningModule):
             self.add_moe_components()
 
         # 🔧 添加camera编码器（wan_video_dit_moe.py已经包含MoE逻辑）
-        dim = self.pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+        dim = self.pipe.dit.blocks[0].self_attn.dim
         for block in self.pipe.dit.blocks:
             # 🔧 简化：只添加传统camera编码器，MoE逻辑在wan_video_dit_moe.py中
             block.cam_encoder = nn.Linear(13, dim)
@@ -708,6 +710,10 @@ class MultiDatasetLightningModelForTrain(pl.LightningModule):
                                                 "moe", "sekai_processor", "nuscenes_processor","openx_processor"]):
                 for param in module.parameters():
                     param.requires_grad = True
+
+        if compile_blocks:
+            # 🔧 在挂载cam_encoder/moe并设置好requires_grad之后编译DiT block
+            self.pipe.dit.enable_block_compile(dynamic=compile_dynamic)
         
         self.learning_rate = learning_rate
         self.use_gradient_checkpointing = use_gradient_checkpointing
@@ -725,7 +731,7 @@ class MultiDatasetLightningModelForTrain(pl.LightningModule):
         self.pipe.dit.top_k = self.moe_config.get("top_k", 1)
         
         # 为每个block添加MoE组件（modality processors已经在WanModelMoe中全局创建）
-        dim = self.pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+        dim = self.pipe.dit.blocks[0].self_attn.dim
         unified_dim = self.moe_config.get("unified_dim", 30)
         num_experts = self.moe_config.get("num_experts", 4)
         from diffsynth.models.wan_video_dit_moe import MultiModalMoE, ModalityProcessor
@@ -750,7 +756,7 @@ class MultiDatasetLightningModelForTrain(pl.LightningModule):
     def add_framepack_components(self):
         """🔧 添加FramePack相关组件"""
         if not hasattr(self.pipe.dit, 'clean_x_embedder'):
-            inner_dim = self.pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+            inner_dim = self.pipe.dit.blocks[0].self_attn.dim
             
             class CleanXEmbedder(nn.Module):
                 def __init__(self, inner_dim):
@@ -926,7 +932,9 @@ class MultiDatasetLightningModelForTrain(pl.LightningModule):
         t = time.strftime("%Y%m%d-%H%M%S")   # 20250923-153047
 
         
-        state_dict = self.pipe.denoising_model().state_dict()
+        # 🔧 MoE DiT 内部把 q/k/v、k/v 融合成一个 Linear；保存时拆回原始 key，checkpoint 和非 MoE 的 DiT / 外部工具保持兼容
+        from diffsynth.models.wan_video_dit_moe import unfuse_linear_state_dict
+        state_dict = unfuse_linear_state_dict(self.pipe.denoising_model().state_dict())
         torch.save(state_dict, os.path.join(checkpoint_dir, f"step{current_step}_nus_moe_from_{t}.ckpt"))
         print(f"Saved MoE model checkpoint: step{current_step}.ckpt")
 
@@ -1000,7 +1008,9 @@ def train_multi_dataset(args):
         use_gradient_checkpointing_offload=args.use_gradient_checkpointing_offload,
         resume_ckpt_path=args.resume_ckpt_path,
         use_moe=True,  # 总是使用MoE
-        moe_config=moe_config
+        moe_config=moe_config,
+        compile_blocks=args.compile_blocks,
+        compile_dynamic=args.compile_dynamic
     )
 
     trainer = pl.Trainer(
@@ -1038,6 +1048,8 @@ if __name__ == '__main__':
     parser.add_argument("--moe_num_experts", type=int, default=3, help="专家数量")
     parser.add_argument("--moe_top_k", type=int, default=1, help="Top-K专家")
     parser.add_argument("--moe_loss_weight", type=float, default=0.1, help="MoE损失权重")
+    parser.add_argument("--compile_blocks", action="store_true", help="torch.compile每个DiT block (mode=reduce-overhead)")
+    parser.add_argument("--compile_dynamic", action="store_true", help="按动态shape编译block；条件帧数随样本变化时避免反复重编译")
     
     args = parser.parse_args()
     
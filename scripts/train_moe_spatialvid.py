@@ -891,7 +891,7 @@ class MultiDatasetLightningModelForTrain(pl.LightningModule):
             self.add_moe_components()
 
         # 🔧 添加camera编码器（wan_video_dit_moe.py已经包含MoE逻辑）
-        dim = self.pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+        dim = self.pipe.dit.blocks[0].self_attn.dim
         for block in self.pipe.dit.blocks:
             # 🔧 简化：只添加传统camera编码器，MoE逻辑在wan_video_dit_moe.py中
             block.cam_encoder = nn.Linear(13, dim)
@@ -930,7 +930,7 @@ class MultiDatasetLightningModelForTrain(pl.LightningModule):
             print("✅ 添加了MoE配置到模型")
         
         # 为每个block动态添加MoE组件
-        dim = self.pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+        dim = self.pipe.dit.blocks[0].self_attn.dim
         unified_dim = self.moe_config.get("unified_dim", 30)
         
         for i, block in enumerate(self.pipe.dit.blocks):
@@ -959,7 +959,7 @@ class MultiDatasetLightningModelForTrain(pl.LightningModule):
     def add_framepack_components(self):
         """🔧 添加FramePack相关组件"""
         if not hasattr(self.pipe.dit, 'clean_x_embedder'):
-            inner_dim = self.pipe.dit.blocks[0].self_attn.q.weight.shape[0]
+            inner_dim = self.pipe.dit.blocks[0].self_attn.dim
             
             class CleanXEmbedder(nn.Module):
                 def __init__(self, inner_dim):
@@ -1116,7 +1116,9 @@ class MultiDatasetLightningModelForTrain(pl.LightningModule):
         current_step = self.global_step
         checkpoint.clear()
         
-        state_dict = self.pipe.denoising_model().state_dict()
+        # 🔧 MoE DiT 内部把 q/k/v、k/v 融合成一个 Linear；保存时拆回原始 key，checkpoint 和非 MoE 的 DiT / 外部工具保持兼容
+        from diffsynth.models.wan_video_dit_moe import unfuse_linear_state_dict
+        state_dict = unfuse_linear_state_dict(self.pipe.denoising_model().state_dict())
         torch.save(state_dict, os.path.join(checkpoint_dir, f"step{current_step}.ckpt"))
         print(f"Saved MoE model checkpoint: step{current_step}.ckpt")
 
@@ -1,4 +1,3 @@
-import copy
 import os
 import re
 import torch, os, imageio, argparse
@@ -15,8 +14,24 @@ import json
 import torch.nn as nn
 import torch.nn.functional as F
 import shutil
+import functools
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from safetensors import safe_open
+from safetensors.torch import save_file
 import wandb
 import pdb
+try:
+    from torchcodec.decoders import VideoDecoder
+    TORCHCODEC_AVAILABLE = True
+except ImportError:
+    TORCHCODEC_AVAILABLE = False
+try:
+    import bitsandbytes as bnb
+    BNB_AVAILABLE = True
+except ImportError:
+    BNB_AVAILABLE = False
 
 class TextVideoDataset(torch.utils.data.Dataset):
     def __init__(self, base_path, metadata_path, max_num_frames=81, frame_interval=1, num_frames=81, height=480, width=832, is_i2v=False):
@@ -30,45 +45,98 @@ class TextVideoDataset(torch.utils.data.Dataset):
         self.height = height
         self.width = width
         self.is_i2v = is_i2v
-            
-        self.frame_process = v2.Compose([
-            v2.CenterCrop(size=(height, width)),
-            v2.Resize(size=(height, width), antialias=True),
-            v2.ToTensor(),
-            v2.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
-        ])
+
+        # 🔧 初始化时一次性过滤坏文件/帧数不够的视频（只读header，多线程）
+        print(len(self.path), "videos in metadata.")
+        with ThreadPoolExecutor() as executor:
+            is_valid = list(executor.map(self.is_valid_file, self.path))
+        self.text = [text for text, valid in zip(self.text, is_valid) if valid]
+        self.path = [path for path, valid in zip(self.path, is_valid) if valid]
+        print(len(self.path), "valid videos in metadata.")
+        assert len(self.path) > 0
+
+
+    @staticmethod
+    def header_frame_count(reader):
+        # 只读容器header：nframes缺失/为inf时用 duration * fps 估算，不解码、不扫描整个视频流
+        meta = reader.get_meta_data()
+        nframes = meta.get("nframes")
+        if nframes is None or nframes == float("inf"):
+            return int(meta["duration"] * meta["fps"])
+        return int(nframes)
+
+
+    def count_frames(self, file_path):
+        # header-only：帧数偶尔不准的文件由 __getitem__ 的重试兜底
+        if TORCHCODEC_AVAILABLE:
+            return VideoDecoder(file_path, seek_mode="approximate").metadata.num_frames
+        reader = imageio.get_reader(file_path)
+        try:
+            return self.header_frame_count(reader)
+        finally:
+            reader.close()
+
+
+    def is_valid_file(self, file_path):
+        if not os.path.exists(file_path):
+            return False
+        if self.is_image(file_path):
+            return not self.is_i2v
+        try:
+            total_frames = self.count_frames(file_path)
+        except Exception:
+            return False
+        last_frame_id = (self.num_frames - 1) * self.frame_interval
+        return total_frames is not None and total_frames >= self.max_num_frames and total_frames - 1 >= last_frame_id
         
         
-    def crop_and_resize(self, image):
-        width, height = image.size
+    def crop_and_resize(self, frames):
+        # frames: uint8 [T, 3, H, W]；整段视频一次resize，走torchvision原生uint8 kernel
+        height, width = frames.shape[-2:]
         scale = max(self.width / width, self.height / height)
-        image = torchvision.transforms.functional.resize(
-            image,
-            (round(height*scale), round(width*scale)),
-            interpolation=torchvision.transforms.InterpolationMode.BILINEAR
+        frames = v2.functional.resize(
+            frames,
+            [round(height*scale), round(width*scale)],
+            interpolation=v2.InterpolationMode.BILINEAR,
+            antialias=True
         )
-        return image
+        return frames
+
+
+    def frame_process(self, frames):
+        # center crop到(height, width)，再uint8 -> [-1, 1] float (等价于 ToTensor + Normalize(0.5, 0.5))
+        frames = v2.functional.center_crop(frames, [self.height, self.width])
+        return frames.to(torch.float32).div_(127.5).sub_(1.0)
+
 
+    def decode_frames(self, file_path, max_num_frames, frame_ids):
+        # 返回 uint8 [T, 3, H, W]；帧数不够时返回None
+        if TORCHCODEC_AVAILABLE:
+            # 帧数直接读header，所有帧一次batched decode；approximate模式不会先扫描整个文件建索引
+            decoder = VideoDecoder(file_path, seek_mode="approximate")
+            total_frames = decoder.metadata.num_frames
+            if total_frames is None or total_frames < max_num_frames or total_frames - 1 < frame_ids[-1]:
+                return None
+            return decoder.get_frames_at(indices=frame_ids).data
 
-    def load_frames_using_imageio(self, file_path, max_num_frames, start_frame_id, interval, num_frames, frame_process):
         reader = imageio.get_reader(file_path)
-        if reader.count_frames() < max_num_frames or reader.count_frames() - 1 < start_frame_id + (num_frames - 1) * interval:
+        total_frames = self.header_frame_count(reader)
+        if total_frames < max_num_frames or total_frames - 1 < frame_ids[-1]:
             reader.close()
             return None
-        
-        frames = []
-        first_frame = None
-        for frame_id in range(num_frames):
-            frame = reader.get_data(start_frame_id + frame_id * interval)
-            frame = Image.fromarray(frame)
-            frame = self.crop_and_resize(frame)
-            if first_frame is None:
-                first_frame = np.array(frame)
-            frame = frame_process(frame)
-            frames.append(frame)
+        frames = np.stack([reader.get_data(frame_id) for frame_id in frame_ids])
         reader.close()
+        return torch.from_numpy(frames).permute(0, 3, 1, 2).contiguous()
+
 
-        frames = torch.stack(frames, dim=0)
+    def load_frames_using_imageio(self, file_path, max_num_frames, start_frame_id, interval, num_frames):
+        frame_ids = [start_frame_id + frame_id * interval for frame_id in range(num_frames)]
+        frames = self.decode_frames(file_path, max_num_frames, frame_ids)  # [T, 3, H, W] uint8
+        if frames is None:
+            return None
+        frames = self.crop_and_resize(frames)
+        first_frame = frames[0].permute(1, 2, 0).numpy()
+        frames = self.frame_process(frames)
         frames = rearrange(frames, "T C H W -> C T H W")
 
         if self.is_i2v:
@@ -79,7 +147,7 @@ class TextVideoDataset(torch.utils.data.Dataset):
 
     def load_video(self, file_path):
         start_frame_id = 0
-        frames = self.load_frames_using_imageio(file_path, self.max_num_frames, start_frame_id, self.frame_interval, self.num_frames, self.frame_process)
+        frames = self.load_frames_using_imageio(file_path, self.max_num_frames, start_frame_id, self.frame_interval, self.num_frames)
         return frames
     
     
@@ -91,34 +159,38 @@ class TextVideoDataset(torch.utils.data.Dataset):
     
     
     def load_image(self, file_path):
-        frame = Image.open(file_path).convert("RGB")
+        frame = np.array(Image.open(file_path).convert("RGB"))
+        frame = torch.from_numpy(frame).permute(2, 0, 1).unsqueeze(0).contiguous()  # [1, 3, H, W] uint8
         frame = self.crop_and_resize(frame)
-        first_frame = frame
         frame = self.frame_process(frame)
-        frame = rearrange(frame, "C H W -> C 1 H W")
+        frame = rearrange(frame, "T C H W -> C T H W")
         return frame
 
 
-    def __getitem__(self, data_id):
+    def load_item(self, data_id):
         text = self.text[data_id]
         path = self.path[data_id]
-        while True:
-            try:
-                if self.is_image(path):
-                    if self.is_i2v:
-                        raise ValueError(f"{path} is not a video. I2V model doesn't support image-to-image training.")
-                    video = self.load_image(path)
-                else:
-                    video = self.load_video(path)
-                if self.is_i2v:
-                    video, first_frame = video
-                    data = {"text": text, "video": video, "path": path, "first_frame": first_frame}
-                else:
-                    data = {"text": text, "video": video, "path": path}
-                break
-            except:
-                data_id += 1
+        if self.is_image(path):
+            video = self.load_image(path)
+        else:
+            video = self.load_video(path)
+        if video is None:
+            raise ValueError(f"{path} has fewer frames than required.")
+        if self.is_i2v:
+            video, first_frame = video
+            data = {"text": text, "video": video, "path": path, "first_frame": first_frame}
+        else:
+            data = {"text": text, "video": video, "path": path}
         return data
+
+
+    def __getitem__(self, data_id):
+        # 文件已在 __init__ 中过滤；运行时偶发错误只随机换一个样本重试一次
+        try:
+            return self.load_item(data_id)
+        except Exception as e:
+            print(f"ERROR WHEN LOADING {self.path[data_id]}: {e}")
+            return self.load_item(random.randrange(len(self.path)))
     
 
     def __len__(self):
@@ -127,7 +199,7 @@ class TextVideoDataset(torch.utils.data.Dataset):
 
 
 class LightningModelForDataProcess(pl.LightningModule):
-    def __init__(self, text_encoder_path, vae_path, image_encoder_path=None, tiled=False, tile_size=(34, 34), tile_stride=(18, 16)):
+    def __init__(self, text_encoder_path, vae_path, image_encoder_path=None, tiled=False, tile_size=(34, 34), tile_stride=(18, 16), prompt_cache_dir=None, latent_dtype="bf16"):
         super().__init__()
         model_path = [text_encoder_path, vae_path]
         if image_encoder_path is not None:
@@ -135,40 +207,172 @@ class LightningModelForDataProcess(pl.LightningModule):
         model_manager = ModelManager(torch_dtype=torch.bfloat16, device="cpu")
         model_manager.load_models(model_path)
         self.pipe = WanVideoReCamMasterPipeline.from_model_manager(model_manager)
+        # 🔧 VAE 的 3D 卷积走 channels_last_3d（cuDNN 偏好的 NDHWC 布局）
+        self.pipe.vae.to(memory_format=torch.channels_last_3d)
 
         self.tiler_kwargs = {"tiled": tiled, "tile_size": tile_size, "tile_stride": tile_stride}
+        # 🔧 prompt embedding 缓存：磁盘 (prompt_cache_dir/{hash}.pt) + 进程内 LRU
+        self.prompt_cache_dir = prompt_cache_dir
+        self.latent_dtype = latent_dtype
+        self.encode_prompt_cached = functools.lru_cache(maxsize=256)(self.load_or_encode_prompt)
+
+    def load_or_encode_prompt(self, text):
+        cache_path = None
+        if self.prompt_cache_dir is not None:
+            key = hashlib.blake2b(text.encode()).hexdigest()[:16]
+            cache_path = os.path.join(self.prompt_cache_dir, f"{key}.pt")
+            if os.path.exists(cache_path):
+                return torch.load(cache_path, weights_only=True, map_location="cpu")
+        prompt_emb = {k: v.cpu() for k, v in self.pipe.encode_prompt(text).items()}
+        if cache_path is not None:
+            os.makedirs(self.prompt_cache_dir, exist_ok=True)
+            # 先写临时文件再 rename，多卡同时写同一个 key 时不会读到半个文件
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            torch.save(prompt_emb, tmp_path)
+            os.replace(tmp_path, cache_path)
+        return prompt_emb
         
     def test_step(self, batch, batch_idx):
-        text, video, path = batch["text"][0], batch["video"], batch["path"][0]
+        texts, video, paths = batch["text"], batch["video"], batch["path"]
         
         self.pipe.device = self.device
         if video is not None:
-            pth_path = path + ".recam.pth"
-            if not os.path.exists(pth_path):
+            pending = []
+            for i, path in enumerate(paths):
+                if os.path.exists(path + ".recam.safetensors"):
+                    print(f"File {path + '.recam.safetensors'} already exists, skipping.")
+                else:
+                    pending.append(i)
+            if len(pending) == 0:
+                return
+            # video: WanVideoVAE.encode 把整个 batch 一次送进 VAE（VAE 权重本身已是 bf16，无需 autocast）
+            video = video[pending].to(dtype=self.pipe.torch_dtype, device=self.pipe.device, memory_format=torch.channels_last_3d)
+            with torch.inference_mode():
+                latents = self.pipe.encode_video(video, **self.tiler_kwargs)
+            # 🔧 缓存时就中心裁剪到训练尺寸，训练时不再读取/裁掉多余的部分
+            crop_h, crop_w = center_crop_slices(*latents.shape[-2:])
+            latents = latents[..., crop_h, crop_w]
+            _, _, num_frames, height, width = video.shape
+            for j, i in enumerate(pending):
+                cache_path = paths[i] + ".recam.safetensors"
                 # prompt
-                prompt_emb = self.pipe.encode_prompt(text)
-                # video
-                video = video.to(dtype=self.pipe.torch_dtype, device=self.pipe.device)
-                latents = self.pipe.encode_video(video, **self.tiler_kwargs)[0]
+                prompt_emb = self.encode_prompt_cached(texts[i])
                 # image
                 if "first_frame" in batch:
-                    first_frame = Image.fromarray(batch["first_frame"][0].cpu().numpy())
-                    _, _, num_frames, height, width = video.shape
+                    first_frame = Image.fromarray(batch["first_frame"][i].cpu().numpy())
                     image_emb = self.pipe.encode_image(first_frame, num_frames, height, width)
                 else:
                     image_emb = {}
-                data = {"latents": latents, "prompt_emb": prompt_emb, "image_emb": image_emb}
-                torch.save(data, pth_path)
-                print(f"Output: {pth_path}")
-            else:
-                print(f"File {pth_path} already exists, skipping.")
-
-class Camera(object):
-    def __init__(self, c2w):
-        c2w_mat = np.array(c2w).reshape(4, 4)
-        self.c2w_mat = c2w_mat
-        self.w2c_mat = np.linalg.inv(c2w_mat)
-
+                # clone: 避免 torch.save 把整个 batch 的 storage 一起写入
+                data = {"latents": latents[j].clone(), "prompt_emb": prompt_emb, "image_emb": image_emb}
+                save_latent_cache(cache_path, data, latent_dtype=self.latent_dtype)
+                print(f"Output: {cache_path}")
+
+LATENT_CROP_SIZE = (40, 70)  # 训练使用的 latent 尺寸 (H, W)
+
+
+def center_crop_slices(height, width, crop_size=LATENT_CROP_SIZE):
+    target_height, target_width = crop_size
+    h_start = max(height - target_height, 0) // 2
+    w_start = max(width - target_width, 0) // 2
+    return slice(h_start, h_start + min(height, target_height)), slice(w_start, w_start + min(width, target_width))
+
+
+def quantize_latents(latents):
+    # [C, T, H, W] -> int8 + 每个 channel 一个 scale，缓存体积/读取带宽减半
+    latents = latents.float()
+    scale = latents.abs().amax(dim=(1, 2, 3), keepdim=True).clamp_min(1e-8) / 127.0  # [C, 1, 1, 1]
+    quantized = (latents / scale).round_().clamp_(-127, 127).to(torch.int8)
+    return quantized, scale
+
+
+def save_latent_cache(path, data, latent_dtype="bf16"):
+    # {"latents", "prompt_emb": {...}, "image_emb": {...}} -> 扁平的 safetensors: latents, [latents_scale], prompt_emb.context, image_emb.y, ...
+    # latent_dtype 写入 safetensors metadata：bf16 (默认，与 VAE 输出一致、无损) 或 int8 (按 channel 量化，有损，需显式开启)
+    if latent_dtype == "int8":
+        latents, latents_scale = quantize_latents(data["latents"])
+        tensors = {"latents": latents, "latents_scale": latents_scale}
+    elif latent_dtype == "bf16":
+        tensors = {"latents": data["latents"].to(torch.bfloat16)}
+    else:
+        raise ValueError(f"Unsupported latent_dtype: {latent_dtype}")
+    for group in ["prompt_emb", "image_emb"]:
+        for name, tensor in data[group].items():
+            tensors[f"{group}.{name}"] = tensor
+    save_file({key: tensor.detach().cpu().contiguous() for key, tensor in tensors.items()}, path, metadata={"latent_dtype": latent_dtype})
+
+
+def load_latent_cache(path, num_frames, load_embeddings=True):
+    """Load a cached clip, reading only the first num_frames latent frames. Legacy .pth caches are still supported."""
+    if not path.endswith(".safetensors"):
+        data = torch.load(path, weights_only=True, map_location="cpu")
+        # 旧缓存未裁剪，读取时补做中心裁剪
+        crop_h, crop_w = center_crop_slices(*data["latents"].shape[-2:])
+        data["latents"] = data["latents"][:, :num_frames, crop_h, crop_w]
+        return data
+    data = {"prompt_emb": {}, "image_emb": {}}
+    # 🔧 mmap + get_slice：只读取需要的帧，不反序列化整个文件
+    with safe_open(path, framework="pt", device="cpu") as f:
+        latents = f.get_slice("latents")
+        _, total_frames, height, width = latents.get_shape()
+        crop_h, crop_w = center_crop_slices(height, width)
+        latents = latents[:, :min(num_frames, total_frames), crop_h, crop_w]
+        # 没有 metadata 的旧缓存按是否带 latents_scale 判断
+        metadata = f.metadata() or {}
+        latent_dtype = metadata.get("latent_dtype", "int8" if "latents_scale" in f.keys() else "bf16")
+        if latent_dtype == "int8":
+            # int8 缓存：按 channel 反量化回 bf16
+            latents = (latents.float() * f.get_tensor("latents_scale")).to(torch.bfloat16)
+        data["latents"] = latents
+        if load_embeddings:
+            for key in f.keys():
+                if "." in key:
+                    group, name = key.split(".", 1)
+                    data[group][name] = f.get_tensor(key)
+    return data
+
+
+def parse_matrix(matrix_str):
+    # "[a b c d] [e f g h] ..." -> [rows, 4]
+    values = np.fromstring(matrix_str.replace('[', ' ').replace(']', ' '), sep=' ')
+    return values.reshape(-1, 4)
+
+
+@functools.lru_cache(maxsize=256)
+def load_camera_extrinsics(camera_path):
+    """Parse camera_extrinsics.json once per scene -> c2w array [num_frames, max_cam_id + 1, 4, 4] indexed by (frame, cam id).
+    (frame, cam) pairs missing from the json are NaN; read them through select_c2ws, which raises on them."""
+    with open(camera_path, 'r') as file:
+        cam_data = json.load(file)
+    frame_ids = sorted(int(key[len("frame"):]) for key in cam_data)
+    cam_ids = sorted({int(cam_key[len("cam"):]) for frame in cam_data.values() for cam_key in frame})
+    c2ws = np.full((frame_ids[-1] + 1, cam_ids[-1] + 1, 4, 4), np.nan)
+    for frame_id in frame_ids:
+        for cam_key, matrix_str in cam_data[f"frame{frame_id}"].items():
+            m = parse_matrix(matrix_str)
+            # 统一为 4x4 c2w
+            if m.shape not in [(3, 4), (4, 4)]:
+                raise ValueError(f"Unexpected c2w shape: {m.shape}")
+            c2w = c2ws[frame_id, int(cam_key[len("cam"):])]
+            c2w[:m.shape[0]] = m
+            if m.shape[0] == 3:
+                c2w[3] = [0, 0, 0, 1.0]
+    return c2ws
+
+
+def select_c2ws(c2ws, frame_ids, cam_id, camera_path):
+    # 取出 (frame_ids, cam_id) 的 c2w [len(frame_ids), 4, 4]；越界或 json 中缺失时直接报错（由 dataset 重试），不产生退化位姿
+    frame_ids = np.asarray(frame_ids)
+    if frame_ids.max() >= c2ws.shape[0] or cam_id >= c2ws.shape[1]:
+        raise KeyError(f"{camera_path} has no frame {frame_ids.max()} / cam{cam_id:02d}")
+    selected = c2ws[frame_ids, cam_id]
+    if np.isnan(selected).any():
+        missing = frame_ids[np.isnan(selected).any(axis=(1, 2))].tolist()
+        raise KeyError(f"{camera_path} is missing cam{cam_id:02d} for frames {missing}")
+    return selected
+
+
+CAM_RE = re.compile(r'cam(\d+)')
 
 
 class TensorDataset(torch.utils.data.Dataset):
@@ -176,36 +380,28 @@ class TensorDataset(torch.utils.data.Dataset):
         metadata = pd.read_csv(metadata_path)
         self.path = [os.path.join(base_path, "train", file_name) for file_name in metadata["file_name"]]
         print(len(self.path), "videos in metadata.")
-        self.path = [i + ".recam.pth" for i in self.path if os.path.exists(i + ".recam.pth")]
+        self.path = [
+            i + ".recam.safetensors" if os.path.exists(i + ".recam.safetensors") else i + ".recam.pth"
+            for i in self.path if os.path.exists(i + ".recam.safetensors") or os.path.exists(i + ".recam.pth")
+        ]
+        # 路径中没有 camXX 的样本无法配对 condition 相机
+        self.path = [i for i in self.path if CAM_RE.search(i) is not None]
         print(len(self.path), "tensors cached in metadata.")
         assert len(self.path) > 0
+        # 🔧 预先解析路径模板：camXX 两侧的片段 + target 相机编号 + 场景的相机参数文件
+        self.path_parts = []
+        self.tgt_cam_ids = []
+        self.camera_paths = []
+        for path in self.path:
+            parts = CAM_RE.split(path)  # [p0, id, p1, id, p2, ...]
+            self.path_parts.append(parts[0::2])
+            self.tgt_cam_ids.append(int(parts[1]))
+            self.camera_paths.append(os.path.join(path.rsplit('/', 2)[0], "cameras", "camera_extrinsics.json"))
         self.steps_per_epoch = steps_per_epoch
         self.condition_frames = int(condition_frames)
         self.target_frames = int(target_frames)
-
-
-    def parse_matrix(self, matrix_str):
-        rows = matrix_str.strip().split('] [')
-        matrix = []
-        for row in rows:
-            row = row.replace('[', '').replace(']', '')
-            matrix.append(list(map(float, row.split())))
-        return np.array(matrix)
-
-
-    def get_relative_pose(self, cam_params):
-        abs_w2cs = [cam_param.w2c_mat for cam_param in cam_params]
-        abs_c2ws = [cam_param.c2w_mat for cam_param in cam_params]
-        target_cam_c2w = np.array([
-            [1, 0, 0, 0],
-            [0, 1, 0, 0],
-            [0, 0, 1, 0],
-            [0, 0, 0, 1]
-        ])
-        abs2rel = target_cam_c2w @ abs_w2cs[0]
-        ret_poses = [target_cam_c2w, ] + [abs2rel @ abs_c2w for abs_c2w in abs_c2ws[1:]]
-        ret_poses = np.array(ret_poses, dtype=np.float32)
-        return ret_poses
+        # 🔧 target / condition 两个缓存文件并行读取；线程池在各 worker 进程内懒创建
+        self._pool = None
 
 
     def __getitem__(self, index):
@@ -219,63 +415,43 @@ class TensorDataset(torch.utils.data.Dataset):
                 data_id = torch.randint(0, len(self.path), (1,))[0]
                 data_id = (data_id + index) % len(self.path) # For fixed seed.
                 path_tgt = self.path[data_id]
-                data_tgt = torch.load(path_tgt, weights_only=True, map_location="cpu")
 
                 # load the condition latent (不同相机)
-                match = re.search(r'cam(\d+)', path_tgt)
-                tgt_idx = int(match.group(1))
+                tgt_idx = self.tgt_cam_ids[data_id]
                 cond_idx = random.randint(1, 10)
                 while cond_idx == tgt_idx:
                     cond_idx = random.randint(1, 10)
-                path_cond = re.sub(r'cam(\d+)', f'cam{cond_idx:02}', path_tgt)
-                data_cond = torch.load(path_cond, weights_only=True, map_location="cpu")
-
-                # 截取 target 与 condition 帧并按 [target | condition] 拼接
-                lat_tgt_full = data_tgt['latents']            # [C, T, H, W]
-                lat_cond_full = data_cond['latents']          # [C, T, H, W]
-                T_tgt_avail = lat_tgt_full.shape[1]
-                T_cond_avail = lat_cond_full.shape[1]
-                tgt_len = min(self.target_frames, T_tgt_avail)
-                cond_len = min(self.condition_frames, T_cond_avail)
-                lat_tgt = lat_tgt_full[:, :tgt_len, ...]
-                lat_cond = lat_cond_full[:, :cond_len, ...]
+                path_cond = f'cam{cond_idx:02}'.join(self.path_parts[data_id])
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=2)
+                future_tgt = self._pool.submit(load_latent_cache, path_tgt, self.target_frames)
+                future_cond = self._pool.submit(load_latent_cache, path_cond, self.condition_frames, load_embeddings=False)
+                data_tgt = future_tgt.result()
+                data_cond = future_cond.result()
+
+                # 截取 target 与 condition 帧并按 [target | condition] 拼接（读取时已截取）
+                lat_tgt = data_tgt['latents']                 # [C, tgt_len, H, W]
+                lat_cond = data_cond['latents']               # [C, cond_len, H, W]
+                tgt_len = lat_tgt.shape[1]
                 data['latents'] = torch.cat((lat_tgt, lat_cond), dim=1)  # [C, tgt_len+cond_len, H, W]
 
                 data['prompt_emb'] = data_tgt['prompt_emb']
                 data['image_emb'] = {}
                 # load the target trajectory -> 生成 target_len 帧的相机相对位姿嵌入
-                base_path = path_tgt.rsplit('/', 2)[0]
-                tgt_camera_path = os.path.join(base_path, "cameras", "camera_extrinsics.json")
-                with open(tgt_camera_path, 'r') as file:
-                    cam_data = json.load(file)
+                cam_c2ws = load_camera_extrinsics(self.camera_paths[data_id])  # [num_frames, max_cam_id + 1, 4, 4]
 
                 # 均匀采样 target_len 帧的时间索引（0~80）
-                cam_idx = np.linspace(0, 80, tgt_len, dtype=int).tolist()
-
-                multiview_c2ws = []
-                for view_idx in [cond_idx, tgt_idx]:
-                    traj = [self.parse_matrix(cam_data[f"frame{idx}"][f"cam{view_idx:02d}"]) for idx in cam_idx]
-                    # 统一为 4x4 c2w
-                    c2ws = []
-                    for m in traj:
-                        m = np.array(m)
-                        if m.shape == (3, 4):
-                            m = np.vstack([m, np.array([0, 0, 0, 1.0])])
-                        elif m.shape != (4, 4):
-                            raise ValueError(f"Unexpected c2w shape: {m.shape}")
-                        c2ws.append(m)
-                    multiview_c2ws.append(c2ws)
-
-                cond_cam_params = [Camera(cam_param) for cam_param in multiview_c2ws[0]]
-                tgt_cam_params = [Camera(cam_param) for cam_param in multiview_c2ws[1]]
-                relative_poses = []
-                for i in range(len(tgt_cam_params)):
-                    relative_pose = self.get_relative_pose([cond_cam_params[0], tgt_cam_params[i]])
-                    # 取目标相机在相对坐标下的 3x4
-                    relative_poses.append(torch.as_tensor(relative_pose)[:,:3,:][1])
-
-                pose_embedding = torch.stack(relative_poses, dim=0)  # [tgt_len, 3, 4]
-                pose_embedding = rearrange(pose_embedding, 'b c d -> b (c d)')  # [tgt_len, 12]
+                cam_idx = np.linspace(0, 80, tgt_len, dtype=int)
+
+                camera_path = self.camera_paths[data_id]
+                cond_c2w0 = select_c2ws(cam_c2ws, cam_idx[:1], cond_idx, camera_path)[0]  # [4, 4]
+                tgt_c2ws = select_c2ws(cam_c2ws, cam_idx, tgt_idx, camera_path)          # [tgt_len, 4, 4]
+
+                # 🔧 一次批量 matmul：目标相机相对于 condition 首帧的位姿，只算 3x4，直接写入预分配的 float32 buffer
+                w2c0 = np.linalg.inv(cond_c2w0)
+                rel = np.empty((tgt_len, 3, 4), dtype=np.float32)
+                np.matmul(w2c0[:3], tgt_c2ws, out=rel)  # [tgt_len, 3, 4]
+                pose_embedding = torch.from_numpy(rel.reshape(tgt_len, 12))  # [tgt_len, 12]
                 data['camera'] = pose_embedding.to(torch.bfloat16)
                 break
             except Exception as e:
@@ -297,6 +473,9 @@ class LightningModelForTrain(pl.LightningModule):
         resume_ckpt_path=None,
         condition_frames=10,
         target_frames=5,
+        compile_dit=False,
+        use_8bit_adam=False,
+        checkpoint_dir=None,
     ):
         super().__init__()
         model_manager = ModelManager(torch_dtype=torch.bfloat16, device="cpu")
@@ -313,14 +492,24 @@ class LightningModelForTrain(pl.LightningModule):
         for block in self.pipe.dit.blocks:
             block.cam_encoder = nn.Linear(12, dim)
             block.projector = nn.Linear(dim, dim)
-            block.cam_encoder.weight.data.zero_()
-            block.cam_encoder.bias.data.zero_()
-            block.projector.weight = nn.Parameter(torch.eye(dim))
-            block.projector.bias = nn.Parameter(torch.zeros(dim))
+            # 🔧 原地初始化：cam_encoder 全零、projector 为单位阵，不重新绑定 Parameter
+            with torch.no_grad():
+                block.cam_encoder.weight.zero_()
+                block.cam_encoder.bias.zero_()
+                block.projector.weight.copy_(torch.eye(dim, dtype=block.projector.weight.dtype))
+                block.projector.bias.zero_()
         
         if resume_ckpt_path is not None:
-            state_dict = torch.load(resume_ckpt_path, map_location="cpu")
-            self.pipe.dit.load_state_dict(state_dict, strict=True)
+            # 兼容完整 DiT 的 .ckpt 与只含可训练参数的 .safetensors
+            state_dict = load_state_dict(resume_ckpt_path)
+            missing_keys, unexpected_keys = self.pipe.dit.load_state_dict(state_dict, strict=False)
+            assert len(unexpected_keys) == 0, f"Unexpected keys in {resume_ckpt_path}: {unexpected_keys}"
+            resume_keys, resume_is_full = set(state_dict), len(missing_keys) == 0
+
+        if compile_dit:
+            # 原地编译：state_dict的key不带_orig_mod前缀，checkpoint保存/加载不受影响
+            # 训练时T/H/W由crop和配置固定，用静态shape让Inductor充分特化
+            self.pipe.dit.compile(dynamic=False)
 
         self.freeze_parameters()
         for name, module in self.pipe.denoising_model().named_modules():
@@ -338,8 +527,26 @@ class LightningModelForTrain(pl.LightningModule):
                     trainable_params += param.numel()
                     seen_params.add(param)
         print(f"Total number of trainable parameters: {trainable_params}")
+
+        if resume_ckpt_path is not None:
+            # 只含可训练参数的checkpoint必须与当前可训练参数集合完全一致，否则会静默地只加载一部分
+            if not resume_is_full:
+                trainable_names = {name for name, param in self.pipe.dit.named_parameters() if param.requires_grad}
+                unmatched_keys = sorted(resume_keys - trainable_names)
+                untouched_keys = sorted(trainable_names - resume_keys)
+                assert len(unmatched_keys) == 0, f"Keys in {resume_ckpt_path} that are not trainable parameters: {unmatched_keys}"
+                assert len(untouched_keys) == 0, f"Trainable parameters missing from {resume_ckpt_path}: {untouched_keys}"
+            print(f"Loaded {len(resume_keys)} tensors from {resume_ckpt_path} ({'full' if resume_is_full else 'trainable-only'} checkpoint)")
+
+        self.checkpoint_dir = checkpoint_dir
+        self._save_thread = None
+        self._save_error = None
         
         self.learning_rate = learning_rate
+        self.use_8bit_adam = use_8bit_adam
+        # 🔧 loss 先留在 GPU 上累积，每 loss_log_interval 步才 .item() 同步一次
+        self.loss_log_interval = 10
+        self._loss_buf = []
         self.use_gradient_checkpointing = use_gradient_checkpointing
         self.use_gradient_checkpointing_offload = use_gradient_checkpointing_offload
         
@@ -353,44 +560,34 @@ class LightningModelForTrain(pl.LightningModule):
 
     def training_step(self, batch, batch_idx):
         # Data
-        latents = batch["latents"].to(self.device)                # [B, C, T, H, W],  T = tgt_len + cond_len
+        latents = batch["latents"].to(self.device, non_blocking=True)                # [B, C, T, H, W],  T = tgt_len + cond_len
         prompt_emb = batch["prompt_emb"]
-        prompt_emb["context"] = prompt_emb["context"][0].to(self.device)
+        prompt_emb["context"] = prompt_emb["context"][0].to(self.device, non_blocking=True)
         image_emb = batch["image_emb"]
         
-        target_height, target_width = 40, 70  # 根据你的需求调整
-        current_height, current_width = latents.shape[3], latents.shape[4]
-        
-        if current_height > target_height or current_width > target_width:
-            # 中心裁剪
-            h_start = (current_height - target_height) // 2
-            w_start = (current_width - target_width) // 2
-            latents = latents[:, :, :, 
-                            h_start:h_start+target_height, 
-                            w_start:w_start+target_width]
-            
         if "clip_feature" in image_emb:
-            image_emb["clip_feature"] = image_emb["clip_feature"][0].to(self.device)
+            image_emb["clip_feature"] = image_emb["clip_feature"][0].to(self.device, non_blocking=True)
         if "y" in image_emb:
-            image_emb["y"] = image_emb["y"][0].to(self.device)
+            image_emb["y"] = image_emb["y"][0].to(self.device, non_blocking=True)
         
-        cam_emb = batch["camera"].to(self.device)                 # [B, tgt_len, 12] after collate
+        cam_emb = batch["camera"].to(self.device, non_blocking=True)                 # [B, tgt_len, 12] after collate
 
         # Loss
         self.pipe.device = self.device
-        noise = torch.randn_like(latents)
         timestep_id = torch.randint(0, self.pipe.scheduler.num_train_timesteps, (1,))
         timestep = self.pipe.scheduler.timesteps[timestep_id].to(dtype=self.pipe.torch_dtype, device=self.pipe.device)
 
         extra_input = self.pipe.prepare_extra_input(latents)
-        origin_latents = copy.deepcopy(latents)
-        noisy_latents = self.pipe.scheduler.add_noise(latents, noise, timestep)
 
         # 仅保留 condition 段（后半段）为干净；target 段（前 tgt_len 帧）参与去噪训练
         tgt_len = self.target_frames
-        assert noisy_latents.shape[2] >= tgt_len, f"Latent T {noisy_latents.shape[2]} < target_frames {tgt_len}"
-        noisy_latents[:, :, tgt_len:, ...] = origin_latents[:, :, tgt_len:, ...]
-        training_target = self.pipe.scheduler.training_target(latents, noise, timestep)
+        assert latents.shape[2] >= tgt_len, f"Latent T {latents.shape[2]} < target_frames {tgt_len}"
+        # 🔧 noise / add_noise / training_target 只在 target 段上计算
+        tgt_latents = latents[:, :, :tgt_len, ...]
+        noise = torch.randn_like(tgt_latents)
+        noisy_tgt = self.pipe.scheduler.add_noise(tgt_latents, noise, timestep)
+        noisy_latents = torch.cat([noisy_tgt, latents[:, :, tgt_len:, ...]], dim=2)
+        training_target = self.pipe.scheduler.training_target(tgt_latents, noise, timestep)
         
         # Compute loss (只计算 target 段)
         noise_pred = self.pipe.denoising_model()(
@@ -400,31 +597,77 @@ class LightningModelForTrain(pl.LightningModule):
         )
         loss = torch.nn.functional.mse_loss(
             noise_pred[:, :, :tgt_len, ...].float(),
-            training_target[:, :, :tgt_len, ...].float()
+            training_target.float()
         )
         loss = loss * self.pipe.scheduler.training_weight(timestep)
 
-        wandb.log({"train_loss": loss.item()})
+        self._loss_buf.append(loss.detach())
+        if len(self._loss_buf) >= self.loss_log_interval:
+            wandb.log({"train_loss": torch.stack(self._loss_buf).mean().item()})
+            self._loss_buf.clear()
         return loss
 
 
     def configure_optimizers(self):
         trainable_modules = filter(lambda p: p.requires_grad, self.pipe.denoising_model().parameters())
-        optimizer = torch.optim.AdamW(trainable_modules, lr=self.learning_rate)
+        if self.use_8bit_adam:
+            # 8-bit 优化器状态，显存占用约为 fp32 AdamW 的 1/4
+            if not BNB_AVAILABLE:
+                raise ImportError("bitsandbytes is required for --use_8bit_adam.")
+            optimizer = bnb.optim.AdamW8bit(trainable_modules, lr=self.learning_rate, betas=(0.9, 0.999))
+        else:
+            # 🔧 fused AdamW：所有参数的更新合并为少量 kernel
+            optimizer = torch.optim.AdamW(trainable_modules, lr=self.learning_rate, fused=torch.cuda.is_available())
         return optimizer
     
 
+    def write_checkpoint(self, state_dict, save_path):
+        # 后台线程的写盘：异常在这里记录，下一次保存/训练结束时在主线程抛出
+        try:
+            save_file(state_dict, save_path)
+            print(f"Saved checkpoint: {save_path}")
+        except Exception as e:
+            print(f"ERROR WHEN SAVING {save_path}: {e}")
+            self._save_error = e
+
+
+    def wait_for_checkpoint(self):
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._save_thread = None
+        if self._save_error is not None:
+            error, self._save_error = self._save_error, None
+            raise RuntimeError("Saving a checkpoint failed.") from error
+
+
+    def on_train_end(self):
+        self.wait_for_checkpoint()
+
+
+    def teardown(self, stage):
+        self.wait_for_checkpoint()
+
+
     def on_save_checkpoint(self, checkpoint):
-        checkpoint_dir = "/home/zhuyixuan05/ReCamMaster/models/checkpoints"
+        checkpoint_dir = self.checkpoint_dir or os.path.join(self.trainer.default_root_dir, "checkpoints")
         print(f"Checkpoint directory: {checkpoint_dir}")
         current_step = self.global_step
         print(f"Current step: {current_step}")
 
         checkpoint.clear()
-        trainable_param_names = list(filter(lambda named_param: named_param[1].requires_grad, self.pipe.denoising_model().named_parameters()))
-        trainable_param_names = set([named_param[0] for named_param in trainable_param_names])
-        state_dict = self.pipe.denoising_model().state_dict()
-        torch.save(state_dict, os.path.join(checkpoint_dir, f"step{current_step}.ckpt"))
+        if not self.trainer.is_global_zero:
+            return
+        # 🔧 只保存可训练参数（cam_encoder / projector / self_attn），先拷到 CPU 再后台线程写盘，不阻塞训练
+        state_dict = {
+            name: param.detach().to("cpu", copy=True)
+            for name, param in self.pipe.denoising_model().named_parameters() if param.requires_grad
+        }
+        save_path = os.path.join(checkpoint_dir, f"step{current_step}.safetensors")
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        # 上一次保存没写完前不开始新的写入
+        self.wait_for_checkpoint()
+        self._save_thread = threading.Thread(target=self.write_checkpoint, args=(state_dict, save_path))
+        self._save_thread.start()
 
 
 
@@ -527,6 +770,21 @@ def parse_args():
         default=832,
         help="Image width.",
     )
+    parser.add_argument(
+        "--vae_batch_size",
+        type=int,
+        default=1,
+        help="Number of clips encoded by the VAE per step in data_process.",
+    )
+    parser.add_argument(
+        "--latent_dtype",
+        type=str,
+        default="bf16",
+        choices=["bf16", "int8"],
+        help="Storage dtype of cached latents in data_process. bf16 (default) stores the VAE latents exactly. "
+             "int8 stores them with per-channel symmetric quantization (scale = max|x| / 127), halving cache size and "
+             "read bandwidth; it is lossy, with round-off up to scale / 2 per element.",
+    )
     parser.add_argument(
         "--dataloader_num_workers",
         type=int,
@@ -591,6 +849,12 @@ def parse_args():
         type=str,
         default=None,
     )
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default=None,
+        help="Directory for the trainable-parameter .safetensors checkpoints. Defaults to <output_path>/checkpoints.",
+    )
     parser.add_argument(
         "--condition_frames",
         type=int,
@@ -603,6 +867,18 @@ def parse_args():
         default=10,
         help="Number of target frames (to be denoised).",
     )
+    parser.add_argument(
+        "--compile_dit",
+        default=False,
+        action="store_true",
+        help="Whether to torch.compile the DiT denoiser.",
+    )
+    parser.add_argument(
+        "--use_8bit_adam",
+        default=False,
+        action="store_true",
+        help="Whether to use bitsandbytes 8-bit AdamW.",
+    )
     args = parser.parse_args()
     return args
 
@@ -621,8 +897,9 @@ def data_process(args):
     dataloader = torch.utils.data.DataLoader(
         dataset,
         shuffle=False,
-        batch_size=1,
-        num_workers=args.dataloader_num_workers
+        batch_size=args.vae_batch_size,
+        num_workers=args.dataloader_num_workers,
+        pin_memory=True
     )
     model = LightningModelForDataProcess(
         text_encoder_path=args.text_encoder_path,
@@ -631,6 +908,8 @@ def data_process(args):
         tiled=args.tiled,
         tile_size=(args.tile_size_height, args.tile_size_width),
         tile_stride=(args.tile_stride_height, args.tile_stride_width),
+        prompt_cache_dir=os.path.join(args.dataset_path, "cache", "prompt"),
+        latent_dtype=args.latent_dtype,
     )
     trainer = pl.Trainer(
         accelerator="gpu",
@@ -648,11 +927,15 @@ def train(args):
         condition_frames=args.condition_frames,
         target_frames=args.target_frames,
     )
+    # prefetch_factor / persistent_workers 只在多进程加载时可用
+    worker_kwargs = {"prefetch_factor": 4, "persistent_workers": True} if args.dataloader_num_workers > 0 else {}
     dataloader = torch.utils.data.DataLoader(
         dataset,
         shuffle=True,
         batch_size=1,
-        num_workers=args.dataloader_num_workers
+        num_workers=args.dataloader_num_workers,
+        pin_memory=True,
+        **worker_kwargs
     )
     model = LightningModelForTrain(
         dit_path=args.dit_path,
@@ -662,6 +945,9 @@ def train(args):
         resume_ckpt_path=args.resume_ckpt_path,
         condition_frames=args.condition_frames,
         target_frames=args.target_frames,
+        compile_dit=args.compile_dit,
+        use_8bit_adam=args.use_8bit_adam,
+        checkpoint_dir=args.checkpoint_dir,
     )
 
     if args.use_swanlab: